@@ -1,5 +1,7 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, g, send_file, session
+from flask import Flask, Request, render_template, request, redirect, url_for, jsonify, g, send_file, session, has_app_context, has_request_context
+from werkzeug.exceptions import RequestEntityTooLarge
 import json
+import math
 import sqlite3
 from datetime import datetime, timedelta
 import secrets
@@ -10,10 +12,22 @@ import sys
 import io
 import base64
 import zipfile
+import csv
+import tempfile
+import shutil
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import cProfile
+import collections
 import qrcode
+import qrcode.image.svg
 import barcode
-from barcode.writer import ImageWriter
+from barcode.writer import ImageWriter, SVGWriter
 from pypdf import PdfReader, PdfWriter, PageObject
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject, NullObject, NumberObject, StreamObject
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.lib.units import inch
@@ -51,6 +65,13 @@ try:
 except Exception:
     psycopg2 = None
 
+# Prometheus metrics (optional)
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except Exception:
+    prometheus_client = None
+
 app = Flask(__name__)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.config['TEMPLATES_AUTO_RELOAD'] = True
@@ -65,6 +86,81 @@ POSTGRES_URL = (
 if psycopg2 is None:
     POSTGRES_URL = None
 
+# ==================== UPLOAD LIMITS ====================
+# Per-route byte and pixel limits for the tools routes. Each limit can be
+# overridden from the environment; sizes are in bytes, pixels are width*height.
+UPLOAD_LIMITS = {
+    'image_processing': {
+        'max_bytes': int(os.getenv('IMAGE_UPLOAD_MAX_BYTES', str(20 * 1024 * 1024))),
+        'max_pixels': int(os.getenv('IMAGE_MAX_PIXELS', str(40_000_000))),
+    },
+    'img_to_pdf': {
+        'max_bytes': int(os.getenv('IMG_TO_PDF_MAX_BYTES', str(20 * 1024 * 1024))),
+        'max_pixels': int(os.getenv('IMG_TO_PDF_MAX_PIXELS', str(40_000_000))),
+    },
+    'pdf_tools': {
+        'max_bytes': int(os.getenv('PDF_UPLOAD_MAX_BYTES', str(50 * 1024 * 1024))),
+        'max_pixels': None,
+    },
+}
+# 'downscale' decodes oversized JPEGs at a reduced scale; 'reject' refuses them
+IMAGE_OVERSIZE_POLICY = os.getenv('IMAGE_OVERSIZE_POLICY', 'downscale')
+# Uploads larger than this are spooled to a temporary file instead of RAM
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv('UPLOAD_SPOOL_THRESHOLD', str(512 * 1024)))
+# Whole-request cap enforced by Werkzeug before the body is parsed
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', str(100 * 1024 * 1024)))
+# Hard ceiling for any decode; PIL raises DecompressionBombError above twice this
+Image.MAX_IMAGE_PIXELS = int(os.getenv('IMAGE_HARD_MAX_PIXELS', str(200_000_000)))
+
+class LedgerRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Spool every uploaded file; small ones stay in memory, large ones go to disk
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, mode='rb+')
+
+app.request_class = LedgerRequest
+
+def check_upload_size(file, limit_key):
+    """Return the size of an uploaded file, raising 413 if it is over the route limit"""
+    stream = file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    max_bytes = UPLOAD_LIMITS[limit_key]['max_bytes']
+    if max_bytes and size > max_bytes:
+        raise RequestEntityTooLarge(
+            f'{file.filename or "Upload"} is {size / 1048576:.1f} MB; the limit is {max_bytes / 1048576:.0f} MB'
+        )
+    return size
+
+def open_upload_image(file, limit_key):
+    """Open an uploaded image after checking its size from the header only.
+
+    Image.open() reads just the header, so the pixel count is known before
+    any decoding happens. Oversized JPEGs are decoded at a reduced scale when
+    the policy allows it; everything else over the limit is rejected.
+    """
+    check_upload_size(file, limit_key)
+    try:
+        img = Image.open(file.stream)
+    except Image.DecompressionBombError as e:
+        raise RequestEntityTooLarge(str(e))
+    max_pixels = UPLOAD_LIMITS[limit_key]['max_pixels']
+    width, height = img.size
+    if not max_pixels or width * height <= max_pixels:
+        return img
+    if IMAGE_OVERSIZE_POLICY == 'downscale' and img.format == 'JPEG':
+        scale = (max_pixels / float(width * height)) ** 0.5
+        target = (max(1, int(width * scale)), max(1, int(height * scale)))
+        img.info['original_size'] = (width, height)
+        # draft() makes the JPEG decoder skip detail (1/2, 1/4, 1/8 scale)
+        img.draft(img.mode, target)
+        if img.size[0] * img.size[1] > max_pixels:
+            img.thumbnail(target, Image.LANCZOS)
+        return img
+    raise RequestEntityTooLarge(
+        f'{file.filename or "Image"} is {width}x{height} pixels; the limit is {max_pixels:,} pixels'
+    )
+
 @app.template_filter('comma2')
 def comma2(val):
     try:
@@ -87,6 +183,75 @@ def date_format(value):
             continue
     return value
 
+# ==================== METRICS ====================
+# Prometheus metrics, exposed on /metrics when prometheus_client is installed.
+# Under gunicorn set PROMETHEUS_MULTIPROC_DIR so every worker's samples are
+# aggregated (see gunicorn.conf.py).
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+if prometheus_client is not None:
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'ledger_http_request_duration_seconds', 'Request latency by route',
+        ['method', 'endpoint', 'status'])
+    REQUESTS_IN_PROGRESS = prometheus_client.Gauge(
+        'ledger_http_requests_in_progress', 'Requests currently being handled',
+        multiprocess_mode='livesum')
+    DB_QUERY_SECONDS = prometheus_client.Histogram(
+        'ledger_db_query_duration_seconds', 'DB statement latency by route',
+        ['endpoint'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+    DB_CONNECTIONS = prometheus_client.Gauge(
+        'ledger_db_connections', 'Open request-scoped DB connections',
+        multiprocess_mode='livesum')
+    JOB_SECONDS = prometheus_client.Histogram(
+        'ledger_job_duration_seconds', 'Export and file-processing job duration',
+        ['job'], buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+else:
+    REQUEST_SECONDS = REQUESTS_IN_PROGRESS = DB_QUERY_SECONDS = DB_CONNECTIONS = JOB_SECONDS = None
+
+# Routes whose whole request is one export/file job
+JOB_ENDPOINTS = {
+    ('GET', 'export_transactions'): 'export',
+    ('POST', 'image_processing'): 'image_processing',
+    ('POST', 'pdf_tools'): 'pdf_tools',
+    ('POST', 'barcode_batch'): 'barcode_batch',
+}
+
+# ==================== QUERY PROFILER ====================
+# Every statement run through get_db_connection() is timed and tallied on g
+# for the current request: count, total DB time and the slowest few.
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '500'))
+QUERY_PROFILE_TOP = int(os.getenv('QUERY_PROFILE_TOP', '5'))
+
+def record_query(sql, elapsed):
+    if not has_app_context():
+        return
+    stats = g.get('db_stats')
+    if stats is None:
+        stats = g.db_stats = {'count': 0, 'time': 0.0, 'slowest': []}
+    stats['count'] += 1
+    stats['time'] += elapsed
+    if DB_QUERY_SECONDS is not None:
+        endpoint = (request.endpoint if has_request_context() else None) or 'none'
+        DB_QUERY_SECONDS.labels(endpoint).observe(elapsed)
+    slowest = stats['slowest']
+    if len(slowest) < QUERY_PROFILE_TOP or elapsed > slowest[-1][0]:
+        slowest.append((elapsed, ' '.join(sql.split())[:200]))
+        slowest.sort(key=lambda q: q[0], reverse=True)
+        del slowest[QUERY_PROFILE_TOP:]
+
+class ProfiledSqliteConnection(sqlite3.Connection):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
 if psycopg2 is not None:
     class PGConn:
         def __init__(self, dsn):
@@ -103,7 +268,28 @@ if psycopg2 is not None:
                 if self.conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
                     self.conn.rollback()
                 cur = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cur.execute(self._convert_sql(sql), params or [])
+                start = time.perf_counter()
+                try:
+                    cur.execute(self._convert_sql(sql), params or [])
+                finally:
+                    record_query(sql, time.perf_counter() - start)
+                return cur
+            except Exception as e:
+                try:
+                    self.conn.rollback()
+                except Exception:
+                    pass
+                raise e
+        def executemany(self, sql, seq_of_params):
+            try:
+                if self.conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                    self.conn.rollback()
+                cur = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+                start = time.perf_counter()
+                try:
+                    psycopg2.extras.execute_batch(cur, self._convert_sql(sql), list(seq_of_params), page_size=200)
+                finally:
+                    record_query(sql, time.perf_counter() - start)
                 return cur
             except Exception as e:
                 try:
@@ -153,6 +339,9 @@ def init_db():
             )
         ''')
         cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_unique ON clients(client_name, model_id)')
+        # Older databases may have NULL balances; the clients keyset needs a number
+        cursor.execute('UPDATE clients SET balance = 0 WHERE balance IS NULL')
+        cursor.execute('ALTER TABLE clients ALTER COLUMN balance SET DEFAULT 0, ALTER COLUMN balance SET NOT NULL')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS countries (
                 id SERIAL PRIMARY KEY,
@@ -184,7 +373,8 @@ def init_db():
                 email_link TEXT
             )
         ''')
-        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_app_unique ON transactions(app_id, model_id)')
+        if not pg_transactions_partitioned(cursor):
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_app_unique ON transactions(app_id, model_id)')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS balance_history (
                 id SERIAL PRIMARY KEY,
@@ -255,6 +445,33 @@ def init_db():
         ''')
         cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_wallet_model ON wallet(model_id)')
         
+        # Version counters used to invalidate per-worker caches
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute("INSERT INTO cache_versions (name, version) VALUES ('countries', 0) ON CONFLICT (name) DO NOTHING")
+
+        # Batched maintenance jobs (see BACKGROUND JOBS)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS background_jobs (
+                id SERIAL PRIMARY KEY,
+                kind TEXT NOT NULL,
+                model_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'queued',
+                state TEXT,
+                done INTEGER NOT NULL DEFAULT 0,
+                total INTEGER,
+                error TEXT,
+                worker TEXT,
+                heartbeat DOUBLE PRECISION,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_background_jobs_kind ON background_jobs(kind, status)')
+        
         # --- Postgres Migrations (Robust) ---
         print("Checking Postgres schema migrations...", file=sys.stderr)
         
@@ -284,6 +501,7 @@ def init_db():
             ('transactions', 'addition', 'REAL'),
             ('transactions', 'amount_n', 'REAL'),
             ('transactions', 'deleted', 'INTEGER DEFAULT 0'),
+            ('transactions', 'deleted_at', 'TIMESTAMP'),
             ('transactions', 'is_paid', 'INTEGER DEFAULT 0'),
             ('transactions', 'model_id', 'INTEGER'),
             ('wallet', 'providus_dollars', 'REAL DEFAULT 0'),
@@ -332,6 +550,45 @@ def init_db():
             except Exception as e:
                 print(f"Error migrating {table}.app_id: {e}", file=sys.stderr)
 
+        # Optional monthly range partitioning of transactions
+        if PG_PARTITION_TRANSACTIONS:
+            try:
+                if not pg_transactions_partitioned(cursor):
+                    print("Partitioning transactions by month...", file=sys.stderr)
+                    partition_transactions_pg(cursor)
+                ensure_transaction_keys_pg(cursor)
+                ensure_transaction_partitions(cursor)
+            except Exception as e:
+                print(f"Error partitioning transactions: {e}", file=sys.stderr)
+        cursor.execute(PG_ALL_VIEW_SQL)
+
+        # Per-day transaction totals maintained on every write
+        cursor.execute(ROLLUP_TABLE_SQL)
+        cursor.execute(ROLLUP_CLIENT_INDEX_SQL)
+        cursor.execute('SELECT 1 FROM transaction_rollups LIMIT 1')
+        if cursor.fetchone() is None:
+            cursor.execute(ROLLUP_REBUILD_SQL)
+
+        # Indexes for paginated list pages
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_balance_history_client ON balance_history(model_id, client_id, timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_client_page ON transactions(model_id, client_name, deleted, transaction_date, id)')
+        cursor.execute('DROP INDEX IF EXISTS idx_transactions_client')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_balance ON clients(model_id, balance)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_name_prefix ON clients(model_id, lower(client_name) text_pattern_ops)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deleted_transactions_model ON deleted_transactions(model_id, deleted_at, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deleted_transactions_deleted_at ON deleted_transactions(deleted_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_balance_history_transaction ON balance_history(transaction_id)')
+        # Live rows and tombstones (DELETE_MODE=tombstone) each get a partial index
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_live ON transactions(model_id, transaction_date) WHERE deleted = 0')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_tombstones ON transactions(model_id, deleted_at) WHERE deleted = 1')
+
+        # Full-text search vector over the searchable transaction fields
+        try:
+            ensure_column('transactions', 'search_vector', PG_SEARCH_VECTOR_SQL)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_search ON transactions USING GIN (search_vector)')
+        except Exception as e:
+            print(f"Error creating search index: {e}", file=sys.stderr)
+
         conn.autocommit = False
         conn.commit()
         
@@ -390,6 +647,7 @@ def init_db():
         }
         for n, cont in continent_by_country.items():
             cursor.execute('UPDATE countries SET continent = %s WHERE name = %s AND (continent IS NULL OR continent = %s)', (cont, n, ''))
+        cursor.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'countries'")
 
         user = None
         try:
@@ -458,6 +716,8 @@ def init_db():
         cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_unique ON clients(client_name, model_id)')
     except sqlite3.OperationalError:
         pass
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_balance ON clients(model_id, balance)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_name_prefix ON clients(model_id, lower(client_name))')
 
     # --- Countries Table ---
     cursor.execute('''
@@ -565,6 +825,10 @@ def init_db():
         cursor.execute('ALTER TABLE transactions ADD COLUMN deleted INTEGER DEFAULT 0')
     except sqlite3.OperationalError:
         pass
+    try:
+        cursor.execute('ALTER TABLE transactions ADD COLUMN deleted_at TIMESTAMP')
+    except sqlite3.OperationalError:
+        pass
     try:
         cursor.execute('ALTER TABLE transactions ADD COLUMN is_paid INTEGER DEFAULT 0')
     except sqlite3.OperationalError:
@@ -581,6 +845,29 @@ def init_db():
         cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_app_unique ON transactions(app_id, model_id)')
     except sqlite3.OperationalError:
         pass
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_client_page ON transactions(model_id, client_name, deleted, transaction_date, id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_transactions_client')
+    # Live rows and tombstones (DELETE_MODE=tombstone) each get a partial index
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_live ON transactions(model_id, transaction_date) WHERE deleted = 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_tombstones ON transactions(model_id, deleted_at) WHERE deleted = 1')
+
+    # Full-text search index kept in sync by triggers
+    try:
+        fts_exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'transactions_fts'").fetchone()
+        for statement in SQLITE_FTS_SQL:
+            cursor.execute(statement)
+        if not fts_exists:
+            cursor.execute("INSERT INTO transactions_fts(transactions_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError as e:
+        print(f"Full-text search unavailable: {e}", file=sys.stderr)
+
+    # --- Transactions Archive (paid history moved out by archive_transactions) ---
+    try:
+        cursor.execute('ALTER TABLE transactions_archive ADD COLUMN deleted_at TIMESTAMP')
+    except sqlite3.OperationalError:
+        pass
+    for statement in SQLITE_ARCHIVE_SQL:
+        cursor.execute(statement)
 
     # --- Balance History Table ---
     cursor.execute('''
@@ -602,6 +889,8 @@ def init_db():
         cursor.execute('ALTER TABLE balance_history ADD COLUMN model_id INTEGER')
     except sqlite3.OperationalError:
         pass
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_balance_history_client ON balance_history(model_id, client_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_balance_history_transaction ON balance_history(transaction_id)')
 
     # --- Deleted transactions bin ---
     cursor.execute('''
@@ -645,6 +934,9 @@ def init_db():
             cursor.execute(f'ALTER TABLE deleted_transactions ADD COLUMN {col_def[0]} {col_def[1]}')
         except sqlite3.OperationalError:
             pass
+    # Bin page (per model, newest first) and retention purge (oldest first)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deleted_transactions_model ON deleted_transactions(model_id, deleted_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deleted_transactions_deleted_at ON deleted_transactions(deleted_at)')
 
     # --- Users Table ---
     cursor.execute('''
@@ -732,32 +1024,740 @@ def init_db():
     except sqlite3.OperationalError:
         pass
 
+    # --- Cache Versions Table ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('countries', 0)")
+    # Seeding above may have changed countries
+    cursor.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'countries'")
+
+    # --- Background Jobs Table ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS background_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            model_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'queued',
+            state TEXT,
+            done INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            error TEXT,
+            worker TEXT,
+            heartbeat REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_background_jobs_kind ON background_jobs(kind, status)')
+
+    # --- Transaction Rollups Table ---
+    cursor.execute(ROLLUP_TABLE_SQL)
+    cursor.execute(ROLLUP_CLIENT_INDEX_SQL)
+    if cursor.execute('SELECT 1 FROM transaction_rollups LIMIT 1').fetchone() is None:
+        cursor.execute(ROLLUP_REBUILD_SQL)
+
     conn.commit()
     conn.close()
 
+# ==================== TRANSACTION ROLLUPS ====================
+# transaction_rollups holds count, SUM(amount) and SUM(amount_n) per
+# (model, day, client, country, paid flag). Every write path snapshots the
+# affected transaction before and after the change and applies the difference
+# in the same DB transaction, so reports never scan the transactions table.
+ROLLUP_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS transaction_rollups (
+        model_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        client_name TEXT NOT NULL,
+        country_name TEXT NOT NULL,
+        is_paid INTEGER NOT NULL,
+        txn_count INTEGER NOT NULL DEFAULT 0,
+        sum_amount REAL NOT NULL DEFAULT 0,
+        sum_amount_n REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (model_id, day, client_name, country_name, is_paid)
+    )
+'''
+# Per-client totals (client pages, the clients overview) read by client
+ROLLUP_CLIENT_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_transaction_rollups_client ON transaction_rollups(model_id, client_name, is_paid)'
+# A transaction's rollup day, the same in SQL and in rollup_day(): SQLite keeps
+# dates as text and takes its first 10 characters even when date() can't parse
+# it, Postgres has a timestamp. Never NULL, as day is part of the key.
+ROLLUP_DAY_SQL = ("COALESCE(CAST(date(transaction_date) AS TEXT), '')" if POSTGRES_URL
+                  else "substr(CAST(COALESCE(transaction_date, '') AS TEXT), 1, 10)")
+ROLLUP_REBUILD_SQL = f'''
+    INSERT INTO transaction_rollups (model_id, day, client_name, country_name, is_paid, txn_count, sum_amount, sum_amount_n)
+    SELECT model_id, {ROLLUP_DAY_SQL}, client_name, country_name, COALESCE(is_paid, 0),
+           COUNT(*), COALESCE(SUM(amount), 0), COALESCE(SUM(amount_n), 0)
+    FROM transactions_all
+    WHERE model_id IS NOT NULL AND COALESCE(deleted, 0) = 0
+    GROUP BY model_id, {ROLLUP_DAY_SQL}, client_name, country_name, COALESCE(is_paid, 0)
+'''
+
+def rollup_day(value):
+    """Python side of ROLLUP_DAY_SQL"""
+    return str(value if value is not None else '')[:10]
+
+def rollup_snapshot(conn, transaction_id):
+    """The rollup-relevant columns of one live transaction, or None"""
+    return conn.execute('''
+        SELECT model_id, transaction_date, client_name, country_name, is_paid, amount, amount_n
+        FROM transactions WHERE id = ? AND COALESCE(deleted, 0) = 0
+    ''', (transaction_id,)).fetchone()
+
+def _apply_rollup(conn, row, sign):
+    if row is None or row['model_id'] is None:
+        return
+    key = (row['model_id'], rollup_day(row['transaction_date']), row['client_name'],
+           row['country_name'], int(row['is_paid'] or 0))
+    conn.execute('''
+        INSERT INTO transaction_rollups (model_id, day, client_name, country_name, is_paid, txn_count, sum_amount, sum_amount_n)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (model_id, day, client_name, country_name, is_paid) DO UPDATE SET
+            txn_count = transaction_rollups.txn_count + excluded.txn_count,
+            sum_amount = transaction_rollups.sum_amount + excluded.sum_amount,
+            sum_amount_n = transaction_rollups.sum_amount_n + excluded.sum_amount_n
+    ''', key + (sign, sign * (row['amount'] or 0), sign * (row['amount_n'] or 0)))
+    if sign < 0:
+        conn.execute('''
+            DELETE FROM transaction_rollups
+            WHERE model_id = ? AND day = ? AND client_name = ? AND country_name = ? AND is_paid = ? AND txn_count <= 0
+        ''', key)
+
+def rollup_transaction_change(conn, before, after):
+    """Move a transaction's contribution from its `before` to its `after` snapshot"""
+    _apply_rollup(conn, before, -1)
+    _apply_rollup(conn, after, 1)
+
+def rebuild_rollups(conn, model_id=None):
+    """Recompute rollups from transactions (archived included), for one model or all"""
+    if model_id is None:
+        conn.execute('DELETE FROM transaction_rollups')
+        conn.execute(ROLLUP_REBUILD_SQL)
+    else:
+        conn.execute('DELETE FROM transaction_rollups WHERE model_id = ?', (model_id,))
+        conn.execute(ROLLUP_REBUILD_SQL.replace('WHERE model_id IS NOT NULL', 'WHERE model_id = ?'), (model_id,))
+    conn.commit()
+
+# ==================== BACKGROUND JOBS ====================
+# Maintenance work that touches many rows (archiving, purges, clearing a
+# model) is queued in background_jobs and worked through in small batches by a
+# runner thread in each worker. A handler moves one batch and returns its new
+# cursor; the runner stores that cursor and the progress in the same DB
+# transaction as the batch, so a job picked up again after a crash or restart
+# carries on from its last committed batch. A running job whose heartbeat goes
+# stale is taken over by whichever worker polls next.
+BACKGROUND_JOBS = os.getenv('BACKGROUND_JOBS', '1') == '1'
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '30'))
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', '120'))
+JOB_BATCH_PAUSE = float(os.getenv('JOB_BATCH_PAUSE', '0.05'))
+JOB_KEEP_DAYS = int(os.getenv('JOB_KEEP_DAYS', '30'))
+JOB_HANDLERS = {}
+PERIODIC_JOBS = {}  # kind -> seconds between runs
+_WORKER_ID = f'{os.getpid()}-{secrets.token_hex(4)}'
+_job_wakeup = threading.Event()
+_job_runner_lock = threading.Lock()
+_job_runner = None
+
+def job_handler(kind, every=None):
+    """Register fn(conn, job, state) -> (state, processed, finished) for a job kind.
+
+    The handler must not commit; the runner commits each batch together with
+    the job row. With every= the job is also queued that often.
+    """
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        if every:
+            PERIODIC_JOBS[kind] = every
+        return fn
+    return register
+
+def enqueue_job(conn, kind, model_id=None, state=None):
+    """Queue a job unless one of the same kind and model is pending; returns its id"""
+    row = conn.execute("SELECT id FROM background_jobs WHERE kind = ? AND COALESCE(model_id, 0) = ? AND status IN ('queued', 'running') ORDER BY id LIMIT 1",
+                       (kind, model_id or 0)).fetchone()
+    if row:
+        return row['id']
+    params = (kind, model_id, json.dumps(state or {}), time.time())
+    if POSTGRES_URL:
+        job_id = conn.execute('INSERT INTO background_jobs (kind, model_id, state, heartbeat) VALUES (?, ?, ?, ?) RETURNING id', params).fetchone()['id']
+    else:
+        conn.execute('INSERT INTO background_jobs (kind, model_id, state, heartbeat) VALUES (?, ?, ?, ?)', params)
+        job_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    conn.commit()
+    wake_job_runner()
+    return job_id
+
+def job_status(row):
+    """A background_jobs row as a JSON-friendly dict"""
+    job = {k: row[k] for k in ('id', 'kind', 'model_id', 'status', 'done', 'total', 'error')}
+    job['percent'] = min(100, int(100 * job['done'] / job['total'])) if job['total'] else (100 if job['status'] == 'done' else 0)
+    job['updated'] = datetime.fromtimestamp(row['heartbeat']).strftime('%Y-%m-%d %H:%M:%S') if row['heartbeat'] else ''
+    return job
+
+def schedule_periodic_jobs(conn):
+    """Queue periodic jobs that are due and forget old finished ones"""
+    now = time.time()
+    # Shards each hold one model's tables, so their upkeep is queued per model
+    models = [r['id'] for r in conn.execute('SELECT id FROM models').fetchall()] if MODEL_SHARDS else [None]
+    for kind, every in PERIODIC_JOBS.items():
+        for model_id in models:
+            row = conn.execute('SELECT MAX(heartbeat) AS last_run FROM background_jobs WHERE kind = ? AND COALESCE(model_id, 0) = ?',
+                               (kind, model_id or 0)).fetchone()
+            if not row['last_run'] or row['last_run'] < now - every:
+                enqueue_job(conn, kind, model_id)
+    conn.execute("DELETE FROM background_jobs WHERE status IN ('done', 'failed') AND heartbeat < ?", (now - JOB_KEEP_DAYS * 86400,))
+    conn.commit()
+
+def claim_job(conn):
+    """Take the oldest queued (or abandoned) job for this worker, or None"""
+    stale = time.time() - JOB_STALE_SECONDS
+    row = conn.execute("SELECT id FROM background_jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?) ORDER BY id LIMIT 1",
+                       (stale,)).fetchone()
+    if not row:
+        return None
+    cur = conn.execute("UPDATE background_jobs SET status = 'running', worker = ?, heartbeat = ? WHERE id = ? AND (status = 'queued' OR (status = 'running' AND heartbeat < ?))",
+                       (_WORKER_ID, time.time(), row['id'], stale))
+    conn.commit()
+    if cur.rowcount != 1:
+        return None
+    return conn.execute('SELECT * FROM background_jobs WHERE id = ?', (row['id'],)).fetchone()
+
+def run_job(conn, job):
+    """Run a claimed job batch by batch until it finishes, fails or is taken over"""
+    import traceback
+    handler = JOB_HANDLERS.get(job['kind'])
+    state = json.loads(job['state'] or '{}')
+    done = job['done'] or 0
+    started = time.perf_counter()
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {job['kind']}")
+        while True:
+            state, processed, finished = handler(conn, job, state)
+            done += processed
+            cur = conn.execute('UPDATE background_jobs SET state = ?, done = ?, total = ?, status = ?, heartbeat = ? WHERE id = ? AND worker = ?',
+                               (json.dumps(state), done, state.get('total'), 'done' if finished else 'running', time.time(), job['id'], _WORKER_ID))
+            if cur.rowcount != 1:
+                # Another worker decided we were dead and took over
+                conn.rollback()
+                return
+            conn.commit()
+            if finished:
+                break
+            time.sleep(JOB_BATCH_PAUSE)
+        if JOB_SECONDS is not None:
+            JOB_SECONDS.labels(job['kind']).observe(time.perf_counter() - started)
+    except Exception as e:
+        print(f"ERROR in background job {job['id']} ({job['kind']}): {e}", file=sys.stderr)
+        traceback.print_exc()
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        conn.execute("UPDATE background_jobs SET status = 'failed', error = ?, heartbeat = ? WHERE id = ? AND worker = ?",
+                     (str(e), time.time(), job['id'], _WORKER_ID))
+        conn.commit()
+
+def run_pending_jobs(conn):
+    """Queue due periodic jobs, then run everything queued; returns the number run"""
+    schedule_periodic_jobs(conn)
+    count = 0
+    while True:
+        job = claim_job(conn)
+        if job is None:
+            return count
+        if MODEL_SHARDS and job['model_id']:
+            job_conn = open_db_connection(job['model_id'])
+            try:
+                run_job(job_conn, job)
+            finally:
+                job_conn.close()
+        else:
+            run_job(conn, job)
+        count += 1
+
+def _job_runner_loop():
+    import traceback
+    while True:
+        try:
+            conn = open_db_connection()
+            try:
+                run_pending_jobs(conn)
+            finally:
+                conn.close()
+        except Exception:
+            traceback.print_exc()
+        _job_wakeup.wait(JOB_POLL_SECONDS)
+        _job_wakeup.clear()
+
+def start_job_runner():
+    """Start this worker's runner thread (again after a fork) if jobs are enabled"""
+    global _job_runner
+    if not BACKGROUND_JOBS or (_job_runner is not None and _job_runner.is_alive()):
+        return
+    with _job_runner_lock:
+        if _job_runner is None or not _job_runner.is_alive():
+            _job_runner = threading.Thread(target=_job_runner_loop, name='job-runner', daemon=True)
+            _job_runner.start()
+
+def wake_job_runner():
+    start_job_runner()
+    _job_wakeup.set()
+
+@app.before_request
+def ensure_job_runner():
+    start_job_runner()
+
+@app.cli.command('shard-models')
+def shard_models_command():
+    """Move every model's rows from the catalog into its own shard file"""
+    if not MODEL_SHARDS:
+        print('MODEL_SHARDS is off (or DATABASE is Postgres); nothing to do')
+        return
+    conn = open_db_connection()
+    try:
+        models = conn.execute('SELECT id, name FROM models ORDER BY id').fetchall()
+    finally:
+        conn.close()
+    for model in models:
+        existed = os.path.exists(model_shard_path(model['id']))
+        open_db_connection(model['id']).close()
+        print(f"{model['name']}: {'already sharded' if existed else 'moved to ' + model_shard_path(model['id'])}")
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Run queued and due background jobs once (for cron or serverless hosts)"""
+    conn = open_db_connection()
+    try:
+        print(f'Ran {run_pending_jobs(conn)} job(s)')
+    finally:
+        conn.close()
+
+# ==================== ARCHIVE AND PARTITIONS ====================
+# Nearly all traffic is about recent or unpaid transactions, so old history is
+# kept out of the hot path. On Postgres, PG_PARTITION_TRANSACTIONS=1 turns
+# transactions into a table range-partitioned by month on transaction_date, so
+# queries bounded on transaction_date only touch the months they need. On
+# SQLite, ARCHIVE_AFTER_MONTHS=N moves paid transactions older than N months
+# into transactions_archive (ids kept, so balance history still links up).
+# transactions_all is the view reports and exports read: the UNION ALL of both
+# tables on SQLite, plain transactions on Postgres.
+PG_PARTITION_TRANSACTIONS = os.getenv('PG_PARTITION_TRANSACTIONS', '0') == '1'
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '0'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))
+TRANSACTION_COLUMNS = ('id', 'client_name', 'email', 'service_type', 'applicant_name', 'app_id',
+                       'country_name', 'country_price', 'rate', 'addition', 'amount', 'amount_n',
+                       'transaction_date', 'deleted', 'is_paid', 'model_id', 'email_link', 'deleted_at')
+SQLITE_ARCHIVE_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS transactions_archive (
+        id INTEGER PRIMARY KEY,
+        client_name TEXT NOT NULL,
+        email TEXT,
+        service_type TEXT,
+        applicant_name TEXT,
+        app_id INTEGER NOT NULL,
+        country_name TEXT NOT NULL,
+        country_price REAL,
+        rate REAL,
+        addition REAL,
+        amount REAL NOT NULL,
+        amount_n REAL,
+        transaction_date TIMESTAMP,
+        deleted INTEGER DEFAULT 0,
+        is_paid INTEGER DEFAULT 0,
+        model_id INTEGER,
+        email_link TEXT,
+        deleted_at TIMESTAMP,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_archive_app ON transactions_archive(app_id, model_id)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_archive_date ON transactions_archive(model_id, transaction_date)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_archive_client ON transactions_archive(model_id, client_name, transaction_date)',
+    'DROP VIEW IF EXISTS transactions_all',
+    f'''
+    CREATE VIEW transactions_all AS
+        SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions
+        UNION ALL
+        SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions_archive
+    ''',
+]
+PG_ALL_VIEW_SQL = f"CREATE OR REPLACE VIEW transactions_all AS SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions"
+
+def add_months(day, months):
+    """First day of the month `months` after day's month"""
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+def day_after(value):
+    """The day after a 'YYYY-MM-DD' string, for half-open timestamp ranges"""
+    try:
+        return (datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return value
+
+def pg_transactions_partitioned(cursor):
+    cursor.execute("SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relname = 'transactions' AND n.nspname = current_schema()")
+    row = cursor.fetchone()
+    return bool(row) and row['relkind'] == 'p'
+
+def ensure_transaction_partitions(cursor, first_day=None):
+    """Create monthly partitions from first_day's month to PARTITION_MONTHS_AHEAD ahead"""
+    this_month = datetime.now().date().replace(day=1)
+    month = (first_day or this_month).replace(day=1)
+    last = add_months(this_month, PARTITION_MONTHS_AHEAD)
+    while month <= last:
+        following = add_months(month, 1)
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS transactions_p{month:%Y%m} PARTITION OF transactions "
+                       f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')")
+        month = following
+
+# Unique indexes on a partitioned table must include the partition key, so a
+# partitioned transactions table can't keep its id primary key or the
+# (app_id, model_id) unique index. transaction_keys holds one row per
+# transaction and enforces both; a trigger keeps it in step with every
+# insert, update and delete, inside the same transaction.
+PG_TRANSACTION_KEYS_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS transaction_keys (
+        id BIGINT PRIMARY KEY,
+        model_id INTEGER,
+        app_id BIGINT,
+        UNIQUE (app_id, model_id)
+    )
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION sync_transaction_keys() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM transaction_keys WHERE id = OLD.id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO transaction_keys (id, model_id, app_id) VALUES (NEW.id, NEW.model_id, NEW.app_id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS transactions_keys_sync ON transactions',
+    '''
+    CREATE TRIGGER transactions_keys_sync
+    AFTER INSERT OR DELETE OR UPDATE OF id, model_id, app_id ON transactions
+    FOR EACH ROW EXECUTE FUNCTION sync_transaction_keys()
+    ''',
+]
+
+def ensure_transaction_keys_pg(cursor):
+    """Install transaction_keys and its trigger, filling it from existing rows"""
+    for sql in PG_TRANSACTION_KEYS_SQL:
+        cursor.execute(sql)
+    cursor.execute('SELECT 1 FROM transaction_keys LIMIT 1')
+    if cursor.fetchone() is None:
+        cursor.execute('INSERT INTO transaction_keys (id, model_id, app_id) SELECT id, model_id, app_id FROM transactions')
+
+def partition_transactions_pg(cursor):
+    """Rebuild transactions as a monthly range-partitioned table, in one transaction.
+
+    Uniqueness of ids and of (app_id, model_id) moves to transaction_keys;
+    the ids keep coming from the original sequence.
+    """
+    columns = ', '.join(TRANSACTION_COLUMNS)
+    cursor.execute('SELECT MIN(transaction_date) AS first FROM transactions')
+    first = cursor.fetchone()['first']
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('ALTER TABLE transactions RENAME TO transactions_unpartitioned')
+        cursor.execute("SELECT pg_get_serial_sequence('transactions_unpartitioned', 'id') AS seq")
+        sequence = cursor.fetchone()['seq']
+        cursor.execute('CREATE TABLE transactions (LIKE transactions_unpartitioned INCLUDING DEFAULTS INCLUDING GENERATED) PARTITION BY RANGE (transaction_date)')
+        if sequence:
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY transactions.id')
+        cursor.execute('CREATE TABLE transactions_default PARTITION OF transactions DEFAULT')
+        ensure_transaction_partitions(cursor, first.date() if first else None)
+        cursor.execute(f'INSERT INTO transactions ({columns}) SELECT {columns} FROM transactions_unpartitioned')
+        cursor.execute('DROP TABLE transactions_unpartitioned CASCADE')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_id ON transactions(id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_app ON transactions(app_id, model_id)')
+        cursor.execute('DROP TABLE IF EXISTS transaction_keys')
+        ensure_transaction_keys_pg(cursor)
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+
+def archive_transactions_batch(conn, cutoff, after_id, limit=ARCHIVE_BATCH_SIZE):
+    """Move the next batch of paid transactions dated before cutoff to the archive.
+
+    Returns the ids moved; the caller commits.
+    """
+    rows = conn.execute('SELECT id FROM transactions WHERE id > ? AND is_paid = 1 AND COALESCE(deleted, 0) = 0 AND transaction_date < ? ORDER BY id LIMIT ?',
+                        (after_id, cutoff, limit)).fetchall()
+    ids = [r['id'] for r in rows]
+    if ids:
+        columns = ', '.join(TRANSACTION_COLUMNS)
+        marks = ', '.join('?' * len(ids))
+        conn.execute(f'INSERT INTO transactions_archive ({columns}) SELECT {columns} FROM transactions WHERE id IN ({marks})', ids)
+        conn.execute(f'DELETE FROM transactions WHERE id IN ({marks})', ids)
+    return ids
+
+@job_handler('archive_transactions', every=86400 if ARCHIVE_AFTER_MONTHS > 0 and not POSTGRES_URL else None)
+def archive_transactions_job(conn, job, state):
+    if POSTGRES_URL:
+        raise ValueError('Archiving is for SQLite; use PG_PARTITION_TRANSACTIONS on Postgres')
+    if 'cutoff' not in state:
+        months = int(state.get('months') or ARCHIVE_AFTER_MONTHS)
+        if months <= 0:
+            raise ValueError('Archiving is disabled (ARCHIVE_AFTER_MONTHS is 0)')
+        cutoff = add_months(datetime.now().date(), -months).strftime('%Y-%m-%d')
+        total = conn.execute('SELECT COUNT(*) AS n FROM transactions WHERE is_paid = 1 AND COALESCE(deleted, 0) = 0 AND transaction_date < ?',
+                             (cutoff,)).fetchone()['n']
+        return {'months': months, 'cutoff': cutoff, 'after_id': 0, 'total': total}, 0, False
+    ids = archive_transactions_batch(conn, state['cutoff'], state['after_id'])
+    if not ids:
+        return state, 0, True
+    state['after_id'] = ids[-1]
+    return state, len(ids), False
+
+@job_handler('maintain_partitions', every=86400 if POSTGRES_URL and PG_PARTITION_TRANSACTIONS else None)
+def maintain_partitions_job(conn, job, state):
+    """Keep PARTITION_MONTHS_AHEAD months of empty partitions ready"""
+    ensure_transaction_partitions(conn)
+    return state, 0, True
+
+# ==================== MODEL SHARDS ====================
+# With MODEL_SHARDS=1 (SQLite only) each model's rows live in their own file,
+# SHARD_DIR/model_<id>.db, so writes to one model never wait on another's
+# lock and clearing a model is deleting a file. DATABASE stays the catalog for
+# the global tables (users, models, countries, jobs) and is ATTACHed to
+# every shard connection as `catalog`, so unqualified names resolve to
+# whichever file holds the table and a commit spanning both stays atomic.
+# Shard schemas follow the catalog's, and a model's existing rows are moved
+# out of the catalog the first time its shard is opened.
+MODEL_SHARDS = os.getenv('MODEL_SHARDS', '0') == '1' and not POSTGRES_URL
+SHARD_DIR = os.getenv('SHARD_DIR', os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'models'))
+SHARD_TABLES = ('clients', 'transactions', 'balance_history', 'deleted_transactions', 'transaction_rollups', 'transactions_archive', 'wallet')
+# Search index and archive view go with the tables they read
+SHARD_OBJECTS = SHARD_TABLES + ('transactions_fts', 'transactions_all')
+_synced_shards = set()
+_shard_lock = threading.Lock()
+
+def model_shard_path(model_id):
+    return os.path.join(SHARD_DIR, f'model_{int(model_id)}.db')
+
+def sync_shard_schema(shard, catalog):
+    """Create or update a shard's tables, indexes, triggers and views from the catalog's"""
+    marks = ', '.join('?' * len(SHARD_OBJECTS))
+    objects = catalog.execute(f'''
+        SELECT type, name, tbl_name, sql FROM sqlite_master
+        WHERE tbl_name IN ({marks}) AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+        ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 WHEN 'trigger' THEN 2 ELSE 3 END
+    ''', SHARD_OBJECTS).fetchall()
+    existing = {r['name']: r for r in shard.execute('SELECT type, name, sql FROM sqlite_master').fetchall()}
+    for obj in objects:
+        current = existing.get(obj['name'])
+        try:
+            if current is None:
+                shard.execute(obj['sql'])
+            elif obj['type'] == 'table':
+                if obj['sql'].upper().startswith('CREATE VIRTUAL'):
+                    continue
+                have = {c['name'] for c in shard.execute(f"PRAGMA table_info({obj['name']})").fetchall()}
+                for col in catalog.execute(f"PRAGMA table_info({obj['name']})").fetchall():
+                    if col['name'] not in have:
+                        default = f" DEFAULT {col['dflt_value']}" if col['dflt_value'] is not None else ''
+                        shard.execute(f"ALTER TABLE {obj['name']} ADD COLUMN {col['name']} {col['type']}{default}")
+            elif current['sql'] != obj['sql']:
+                shard.execute(f"DROP {obj['type'].upper()} IF EXISTS {obj['name']}")
+                shard.execute(obj['sql'])
+        except sqlite3.OperationalError as e:
+            print(f"Shard schema: {obj['name']}: {e}", file=sys.stderr)
+    shard.commit()
+
+def create_model_shard(model_id):
+    """Build a model's shard and move its rows out of the catalog.
+
+    The shard is written to a temporary file and renamed into place, and the
+    catalog's write lock is held throughout, so a crash leaves either no shard
+    (and the rows still in the catalog) or a complete one.
+    """
+    path = model_shard_path(model_id)
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    catalog = sqlite3.connect(DATABASE, timeout=20, isolation_level=None)
+    catalog.row_factory = sqlite3.Row
+    try:
+        catalog.execute('BEGIN IMMEDIATE')
+        if os.path.exists(path):
+            catalog.execute('ROLLBACK')
+            return
+        building = path + '.new'
+        remove_file(building)
+        shard = sqlite3.connect(building)
+        shard.row_factory = sqlite3.Row
+        try:
+            sync_shard_schema(shard, catalog)
+            # FTS rows are written by the triggers as the transactions arrive
+            for table in SHARD_TABLES:
+                rows = catalog.execute(f'SELECT * FROM {table} WHERE model_id = ?', (model_id,))
+                columns = [d[0] for d in rows.description]
+                insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+                while True:
+                    batch = rows.fetchmany(1000)
+                    if not batch:
+                        break
+                    shard.executemany(insert, [tuple(r) for r in batch])
+            shard.commit()
+        finally:
+            shard.close()
+        os.replace(building, path)
+        for table in SHARD_TABLES:
+            catalog.execute(f'DELETE FROM {table} WHERE model_id = ?', (model_id,))
+        catalog.execute('COMMIT')
+    except Exception:
+        if catalog.in_transaction:
+            catalog.execute('ROLLBACK')
+        raise
+    finally:
+        catalog.close()
+
+def drop_model_shard(model_id):
+    """Delete a model's shard file; the next connection to it starts empty.
+
+    The shard is locked exclusively first, so no other connection is part-way
+    through a transaction or leaves a hot journal behind, and renamed aside
+    while the lock is held; the renamed file is deleted once it is released.
+    """
+    # Rows never moved out of the catalog would otherwise come back on reopen
+    catalog = sqlite3.connect(DATABASE, timeout=20)
+    try:
+        for table in SHARD_TABLES:
+            catalog.execute(f'DELETE FROM {table} WHERE model_id = ?', (model_id,))
+        catalog.commit()
+    finally:
+        catalog.close()
+    path = model_shard_path(model_id)
+    if os.path.exists(path):
+        dropped = f'{path}.dropped-{secrets.token_hex(4)}'
+        shard = sqlite3.connect(path, timeout=20, isolation_level=None)
+        try:
+            shard.execute('BEGIN EXCLUSIVE')
+            os.replace(path, dropped)
+            shard.execute('ROLLBACK')
+        finally:
+            shard.close()
+        remove_file(dropped)
+    with _shard_lock:
+        _synced_shards.discard(int(model_id))
+
+def open_model_shard(model_id):
+    path = model_shard_path(model_id)
+    if not os.path.exists(path):
+        create_model_shard(model_id)
+    conn = sqlite3.connect(path, timeout=20, factory=ProfiledSqliteConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute('ATTACH DATABASE ? AS catalog', (DATABASE,))
+    with _shard_lock:
+        synced = int(model_id) in _synced_shards
+    if not synced:
+        # Pick up columns and indexes added to the catalog since the shard was made
+        catalog = sqlite3.connect(DATABASE, timeout=20)
+        catalog.row_factory = sqlite3.Row
+        try:
+            sync_shard_schema(conn, catalog)
+        finally:
+            catalog.close()
+        with _shard_lock:
+            _synced_shards.add(int(model_id))
+    return conn
+
+def open_db_connection(model_id=None):
+    """A new connection, for use outside the request cycle (jobs, CLI).
+
+    With MODEL_SHARDS, passing a model_id opens that model's shard.
+    """
+    if POSTGRES_URL:
+        return PGConn(POSTGRES_URL)
+    if MODEL_SHARDS and model_id:
+        return open_model_shard(model_id)
+    conn = sqlite3.connect(DATABASE, timeout=20, factory=ProfiledSqliteConnection)
+    conn.row_factory = sqlite3.Row
+    return conn
+
 def get_db_connection():
     """Get database connection"""
+    model_id = current_model_id() if MODEL_SHARDS and has_request_context() else None
+    if 'db' in g and g.get('db_model') != model_id:
+        # The session switched model (or just got one) since the connection opened
+        close_db()
     if 'db' not in g:
-        if POSTGRES_URL:
-            g.db = PGConn(POSTGRES_URL)
-        else:
-            g.db = sqlite3.connect(DATABASE, timeout=20)
-            g.db.row_factory = sqlite3.Row
+        g.db = open_db_connection(model_id)
+        g.db_model = model_id
+        if DB_CONNECTIONS is not None:
+            DB_CONNECTIONS.inc()
     return g.db
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if REQUESTS_IN_PROGRESS is not None:
+        REQUESTS_IN_PROGRESS.inc()
+        g.in_progress_counted = True
+
+@app.teardown_request
+def finish_request_timer(e=None):
+    if g.pop('in_progress_counted', False):
+        REQUESTS_IN_PROGRESS.dec()
+
+@app.after_request
+def report_query_stats(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    stats = g.get('db_stats') or {'count': 0, 'time': 0.0, 'slowest': []}
+    db_ms = stats['time'] * 1000
+    if elapsed_ms >= SLOW_REQUEST_MS:
+        print(json.dumps({
+            'event': 'slow_request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(elapsed_ms, 1),
+            'db_queries': stats['count'],
+            'db_ms': round(db_ms, 1),
+            'slowest': [{'ms': round(t * 1000, 2), 'sql': q} for t, q in stats['slowest']],
+        }), file=sys.stderr)
+    if REQUEST_SECONDS is not None and request.endpoint != 'metrics':
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_SECONDS.labels(request.method, endpoint, str(response.status_code)).observe(elapsed_ms / 1000)
+        job = JOB_ENDPOINTS.get((request.method, endpoint))
+        if job:
+            JOB_SECONDS.labels(job).observe(elapsed_ms / 1000)
+    if app.debug:
+        response.headers['X-DB-Queries'] = str(stats['count'])
+        response.headers['Server-Timing'] = f'db;dur={db_ms:.1f};desc="{stats["count"]} queries", total;dur={elapsed_ms:.1f}'
+    return response
+
 @app.teardown_appcontext
 def close_db(e=None):
     """Close the database connection"""
     db = g.pop('db', None)
     if db is not None:
         db.close()
+        if DB_CONNECTIONS is not None:
+            DB_CONNECTIONS.dec()
 
 def login_required():
     return bool(session.get('user_id'))
 
 @app.before_request
 def require_login():
-    allowed = {'/login', '/logout'}
+    allowed = {'/login', '/logout', '/metrics'}
     path = request.path
     if path.startswith('/static/'):
         return
@@ -783,10 +1783,208 @@ def require_login():
 
 def current_model_id():
     return session.get('model_id')
+
+# ==================== COUNTRY CATALOG ====================
+# Each worker keeps the whole countries table in memory as
+# {name: (price, continent)}. A version counter in cache_versions is bumped
+# whenever countries change, and a worker reloads when its copy is stale.
+_country_catalog = {'version': None, 'countries': {}}
+
+def bump_cache_version(conn, name):
+    """Mark a cached catalog stale for every worker (commit with the change)"""
+    conn.execute('UPDATE cache_versions SET version = version + 1 WHERE name = ?', (name,))
+
+def cache_version(conn, name):
+    try:
+        row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()
+        return row['version'] if row else None
+    except Exception:
+        # Table not migrated yet; never trust the cache
+        return None
+
+def country_catalog(conn):
+    """Return the {name: (price, continent)} catalog, reloading it if stale"""
+    global _country_catalog
+    if 'country_catalog' in g:
+        return g.country_catalog
+    version = cache_version(conn, 'countries')
+    cached = _country_catalog
+    if version is None or cached['version'] != version:
+        rows = conn.execute('SELECT name, COALESCE(price, 0.0) AS price, continent FROM countries ORDER BY name').fetchall()
+        cached = {'version': version, 'countries': {r['name']: (float(r['price']), r['continent']) for r in rows}}
+        _country_catalog = cached
+    g.country_catalog = cached['countries']
+    g.country_catalog_version = cached['version']
+    return g.country_catalog
+
+def country_list(conn):
+    """Countries as name/price/continent dicts sorted by name, for templates"""
+    catalog = country_catalog(conn)
+    return [{'name': name, 'price': price, 'continent': continent}
+            for name, (price, continent) in sorted(catalog.items())]
+
+# ==================== TYPEAHEAD ====================
+# Pickers fetch matches as the user types instead of rendering every option.
+# Matching is case-insensitive on the start of the name so it can use an index.
+TYPEAHEAD_LIMIT = int(os.getenv('TYPEAHEAD_LIMIT', '20'))
+
+def typeahead_limit():
+    try:
+        limit = int(request.args.get('limit', TYPEAHEAD_LIMIT))
+    except (TypeError, ValueError):
+        limit = TYPEAHEAD_LIMIT
+    return max(1, min(limit, 100))
+
+def prefix_upper_bound(prefix):
+    """Smallest string greater than every string starting with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def client_prefix_matches(conn, model_id, prefix, limit):
+    """Client names in a model starting with prefix (case-insensitive)"""
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return conn.execute('SELECT client_name FROM clients WHERE model_id = ? ORDER BY lower(client_name) LIMIT ?',
+                            (model_id, limit)).fetchall()
+    if POSTGRES_URL:
+        # Served by the text_pattern_ops index on lower(client_name)
+        pattern = re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+        return conn.execute("SELECT client_name FROM clients WHERE model_id = ? AND lower(client_name) LIKE ? ORDER BY lower(client_name) LIMIT ?",
+                            (model_id, pattern, limit)).fetchall()
+    # SQLite only uses an expression index for LIKE on NOCASE columns, so
+    # spell the prefix out as a range
+    return conn.execute('SELECT client_name FROM clients WHERE model_id = ? AND lower(client_name) >= ? AND lower(client_name) < ? ORDER BY lower(client_name) LIMIT ?',
+                        (model_id, prefix, prefix_upper_bound(prefix), limit)).fetchall()
+
+def country_prefix_matches(conn, prefix, limit):
+    """Catalog countries whose name starts with prefix (case-insensitive)"""
+    prefix = prefix.strip().lower()
+    matches = []
+    for country in country_list(conn):
+        if country['name'].lower().startswith(prefix):
+            matches.append(country)
+            if len(matches) >= limit:
+                break
+    return matches
+
+# ==================== PAGINATION ====================
+# List pages use keyset pagination: the page after a row is everything that
+# sorts after its (sort value, id) pair, so deep pages cost the same as the
+# first one. Cursors travel as "<value>|<id>" in the query string; a NULL sort
+# value travels as an empty one.
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '50'))
+
+def encode_cursor(value, row_id):
+    return f"{'' if value is None else value}|{row_id}"
+
+def decode_cursor(raw):
+    """Return (value, id) from a cursor string, or None if absent/invalid"""
+    if not raw or '|' not in raw:
+        return None
+    value, _, row_id = raw.rpartition('|')
+    try:
+        return value, int(row_id)
+    except ValueError:
+        return None
+
+def split_page(rows, limit):
+    """Rows fetched with LIMIT limit + 1 -> (page rows, has_more)"""
+    rows = list(rows)
+    return rows[:limit], len(rows) > limit
+
 def can(permission):
     perms = session.get('permissions', {})
     return bool(perms.get(permission)) or bool(perms.get('is_admin'))
 
+# ==================== REQUEST PROFILER ====================
+# Opt-in profiling of a single request: an admin adds ?_profile=1 (cProfile)
+# or ?_profile=sample (sampled collapsed stacks, for flame graphs), or any
+# client sends X-Profile: <PROFILE_SECRET>. Only the last PROFILE_KEEP
+# profiles are kept in PROFILE_DIR.
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'ledger-profiles'))
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '20'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+_PROFILE_NAME_RE = re.compile(r'^[\w.-]+\.(prof|collapsed)$')
+
+class StackSampler:
+    """Samples one thread's stack on a timer and counts collapsed stacks"""
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    def start(self):
+        self._thread.start()
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+    def dump(self, path):
+        with open(path, 'w') as fh:
+            for stack, count in self.counts.most_common():
+                fh.write(f'{stack} {count}\n')
+
+def requested_profile_mode():
+    """Return 'cprofile', 'sample' or None for the current request"""
+    # Only explicit modes switch profiling on; ?_profile=0 and the like don't
+    modes = {'1': 'cprofile', 'cprofile': 'cprofile', 'sample': 'sample'}
+    flag = request.args.get('_profile')
+    header = request.headers.get('X-Profile')
+    if header and PROFILE_SECRET and secrets.compare_digest(header, PROFILE_SECRET):
+        return modes.get(flag or request.headers.get('X-Profile-Mode') or 'cprofile')
+    if flag and can('is_admin'):
+        return modes.get(flag)
+    return None
+
+def prune_profiles():
+    try:
+        names = sorted((n for n in os.listdir(PROFILE_DIR) if _PROFILE_NAME_RE.match(n)),
+                       key=lambda n: os.path.getmtime(os.path.join(PROFILE_DIR, n)), reverse=True)
+    except OSError:
+        return
+    for name in names[PROFILE_KEEP:]:
+        remove_file(os.path.join(PROFILE_DIR, name))
+
+@app.before_request
+def start_profiler():
+    mode = requested_profile_mode()
+    if mode == 'sample':
+        g.profiler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+        g.profiler.start()
+    elif mode == 'cprofile':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def save_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    base = f"{stamp}-{request.method}-{(request.endpoint or 'unmatched').replace('.', '_')}"
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+        name = base + '.collapsed'
+        profiler.dump(os.path.join(PROFILE_DIR, name))
+    else:
+        profiler.disable()
+        name = base + '.prof'
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    prune_profiles()
+    response.headers['X-Profile-Id'] = name
+    return response
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -897,7 +2095,12 @@ def models():
         edit_id = int(request.args.get('edit_id')) if request.args.get('edit_id') else None
     except ValueError:
         edit_id = None
-    return render_template('models.html', models=rows, edit_id=edit_id, error=request.args.get('error'), message=request.args.get('message'))
+    # Latest unfinished clear per model, for the progress column
+    clearing = {}
+    for job in conn.execute("SELECT * FROM background_jobs WHERE kind = 'clear_model' AND status IN ('queued', 'running', 'failed') ORDER BY id").fetchall():
+        clearing[job['model_id']] = job_status(job)
+    return render_template('models.html', models=rows, edit_id=edit_id, clearing=clearing,
+                           error=request.args.get('error'), message=request.args.get('message'))
 
 @app.route('/models/add', methods=['GET', 'POST'])
 def add_model():
@@ -926,19 +2129,62 @@ def select_model(model_id):
     session['model_name'] = m['name']
     return redirect(url_for('index'))
 
+# Clearing a model deletes its rows table by table, children first, in
+# CLEAR_BATCH_SIZE batches so no single transaction holds the lock for long
+CLEAR_BATCH_SIZE = int(os.getenv('CLEAR_BATCH_SIZE', '1000'))
+
+@job_handler('clear_model')
+def clear_model_job(conn, job, state):
+    mid = job['model_id']
+    if 'tables' not in state:
+        tables = ['balance_history', 'deleted_transactions', 'transactions', 'transaction_rollups', 'clients']
+        if not POSTGRES_URL:
+            tables.insert(3, 'transactions_archive')
+        total = sum(conn.execute(f'SELECT COUNT(*) AS n FROM {t} WHERE model_id = ?', (mid,)).fetchone()['n'] for t in tables)
+        return {'tables': tables, 'total': total}, 0, False
+    while state['tables']:
+        table = state['tables'][0]
+        if table == 'transaction_rollups':
+            # No id column; take the first days, the key after model_id
+            cur = conn.execute('''
+                DELETE FROM transaction_rollups WHERE model_id = ? AND day <= (
+                    SELECT MAX(day) FROM (SELECT day FROM transaction_rollups WHERE model_id = ? ORDER BY day LIMIT ?) first_days)
+            ''', (mid, mid, CLEAR_BATCH_SIZE))
+        else:
+            cur = conn.execute(f'DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE model_id = ? LIMIT ?)', (mid, CLEAR_BATCH_SIZE))
+        if cur.rowcount > 0:
+            return state, cur.rowcount, False
+        state['tables'].pop(0)
+    return state, 0, True
+
 @app.route('/models/clear', methods=['POST'])
 def clear_current_model():
-    """Clear all records for the current model"""
+    """Clear all records for the current model (in the background)"""
     if not can('is_admin'):
         return redirect(url_for('models'))
-    conn = get_db_connection()
     mid = current_model_id()
-    conn.execute('DELETE FROM balance_history WHERE model_id = ?', (mid,))
-    conn.execute('DELETE FROM deleted_transactions WHERE model_id = ?', (mid,))
-    conn.execute('DELETE FROM transactions WHERE model_id = ?', (mid,))
-    conn.execute('DELETE FROM clients WHERE model_id = ?', (mid,))
-    conn.commit()
-    return redirect(url_for('models'))
+    if not mid:
+        return redirect(url_for('models'))
+    if MODEL_SHARDS:
+        # Clearing never touched the wallet; carry it over to the fresh shard
+        close_db()
+        conn = open_db_connection(mid)
+        try:
+            wallet = conn.execute('SELECT * FROM wallet WHERE model_id = ?', (mid,)).fetchone()
+        finally:
+            conn.close()
+        drop_model_shard(mid)
+        if wallet:
+            conn = open_db_connection(mid)
+            try:
+                columns = wallet.keys()
+                conn.execute(f"INSERT INTO wallet ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", tuple(wallet))
+                conn.commit()
+            finally:
+                conn.close()
+        return redirect(url_for('models', message='Model data cleared'))
+    enqueue_job(get_db_connection(), 'clear_model', mid)
+    return redirect(url_for('models', message='Clearing model data in the background'))
 
 @app.route('/models/<int:model_id>/edit', methods=['GET','POST'])
 def edit_model(model_id):
@@ -965,13 +2211,28 @@ def edit_model(model_id):
 def delete_model(model_id):
     if not can('is_admin'):
         return redirect(url_for('models'))
-    conn = get_db_connection()
-    conn.execute('DELETE FROM balance_history WHERE model_id = ?', (model_id,))
-    conn.execute('DELETE FROM deleted_transactions WHERE model_id = ?', (model_id,))
-    conn.execute('DELETE FROM transactions WHERE model_id = ?', (model_id,))
-    conn.execute('DELETE FROM clients WHERE model_id = ?', (model_id,))
-    conn.execute('DELETE FROM models WHERE id = ?', (model_id,))
-    conn.commit()
+    if MODEL_SHARDS:
+        # Its rows go with the shard file; only the catalog entries remain
+        close_db()
+        conn = open_db_connection()
+        try:
+            conn.execute("DELETE FROM background_jobs WHERE model_id = ? AND status = 'queued'", (model_id,))
+            conn.execute('DELETE FROM models WHERE id = ?', (model_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        drop_model_shard(model_id)
+    else:
+        conn = get_db_connection()
+        conn.execute('DELETE FROM balance_history WHERE model_id = ?', (model_id,))
+        conn.execute('DELETE FROM deleted_transactions WHERE model_id = ?', (model_id,))
+        conn.execute('DELETE FROM transactions WHERE model_id = ?', (model_id,))
+        if not POSTGRES_URL:
+            conn.execute('DELETE FROM transactions_archive WHERE model_id = ?', (model_id,))
+        conn.execute('DELETE FROM transaction_rollups WHERE model_id = ?', (model_id,))
+        conn.execute('DELETE FROM clients WHERE model_id = ?', (model_id,))
+        conn.execute('DELETE FROM models WHERE id = ?', (model_id,))
+        conn.commit()
     if session.get('model_id') == model_id:
         session.pop('model_id', None)
         session.pop('model_name', None)
@@ -985,6 +2246,76 @@ def list_users():
     users = conn.execute('SELECT * FROM users ORDER BY username').fetchall()
     return render_template('users.html', users=users, error=request.args.get('error'))
 
+@app.route('/admin/profiles')
+def list_profiles():
+    if not can('is_admin'):
+        return redirect(url_for('index'))
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for name in os.listdir(PROFILE_DIR):
+            if not _PROFILE_NAME_RE.match(name):
+                continue
+            st = os.stat(os.path.join(PROFILE_DIR, name))
+            profiles.append({'name': name, 'size': st.st_size,
+                             'created': datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+                             'kind': 'cProfile' if name.endswith('.prof') else 'Sampled stacks'})
+    profiles.sort(key=lambda p: p['created'], reverse=True)
+    return render_template('profiles.html', profiles=profiles, keep=PROFILE_KEEP, error=request.args.get('error'))
+
+@app.route('/admin/profiles/<name>')
+def download_profile(name):
+    if not can('is_admin'):
+        return redirect(url_for('index'))
+    path = os.path.join(PROFILE_DIR, name)
+    if not _PROFILE_NAME_RE.match(name) or not os.path.isfile(path):
+        return redirect(url_for('list_profiles', error='Profile not found'))
+    return send_file(path, as_attachment=True, download_name=name,
+                     mimetype='application/octet-stream' if name.endswith('.prof') else 'text/plain')
+
+@app.route('/admin/jobs')
+def list_jobs():
+    if not can('is_admin'):
+        return redirect(url_for('index'))
+    conn = get_db_connection()
+    rows = conn.execute('SELECT * FROM background_jobs ORDER BY id DESC LIMIT 50').fetchall()
+    return render_template('jobs.html', jobs=[job_status(r) for r in rows], periodic=PERIODIC_JOBS,
+                           archive_months=ARCHIVE_AFTER_MONTHS or 12, can_archive=not POSTGRES_URL,
+                           error=request.args.get('error'), message=request.args.get('message'))
+
+@app.route('/admin/jobs/archive', methods=['POST'])
+def queue_archive_job():
+    if not can('is_admin'):
+        return redirect(url_for('index'))
+    try:
+        months = int(request.form.get('months', ''))
+    except ValueError:
+        months = 0
+    if months <= 0:
+        return redirect(url_for('list_jobs', error='Months must be a positive number'))
+    # Each shard is archived on its own; otherwise one job covers every model
+    enqueue_job(get_db_connection(), 'archive_transactions', current_model_id() if MODEL_SHARDS else None, {'months': months})
+    return redirect(url_for('list_jobs', message='Archiving queued'))
+
+@app.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    if not can('is_admin'):
+        return redirect(url_for('index'))
+    conn = get_db_connection()
+    conn.execute("UPDATE background_jobs SET status = 'queued', error = NULL, worker = NULL WHERE id = ? AND status = 'failed'", (job_id,))
+    conn.commit()
+    wake_job_runner()
+    return redirect(url_for('list_jobs', message='Job queued again'))
+
+@app.route('/api/jobs/<int:job_id>')
+def api_job(job_id):
+    """Progress of one background job"""
+    if not can('is_admin'):
+        return jsonify({'error': 'Forbidden'}), 403
+    row = get_db_connection().execute('SELECT * FROM background_jobs WHERE id = ?', (job_id,)).fetchone()
+    if not row:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(row))
+
 @app.route('/users/add', methods=['GET','POST'])
 def add_user():
     if not can('is_admin'):
@@ -1189,10 +2520,10 @@ def index():
         
         # Get total number of transactions
         try:
-            total_transactions = conn.execute('SELECT COUNT(*) FROM transactions WHERE model_id = %s', (mid,)).fetchone()['count']
+            total_transactions = conn.execute('SELECT COUNT(*) FROM transactions WHERE model_id = %s AND deleted = 0', (mid,)).fetchone()['count']
         except:
              try:
-                total_transactions = conn.execute('SELECT COUNT(*) FROM transactions WHERE model_id = ?', (mid,)).fetchone()[0]
+                total_transactions = conn.execute('SELECT COUNT(*) FROM transactions WHERE model_id = ? AND deleted = 0', (mid,)).fetchone()[0]
              except:
                 total_transactions = 0
         
@@ -1285,14 +2616,77 @@ def index():
         debug_html = "<br>".join(str(x) for x in debug_info)
         return f"<h1>Dashboard Error</h1><pre>{traceback.format_exc()}</pre><h3>Debug Info</h3><pre>{debug_html}</pre>", 500
 
+# sort key -> (expression, direction) for the clients overview. balance is
+# NOT NULL on both backends, so the default sort walks idx_clients_balance.
+CLIENT_SORTS = {
+    'balance': ('c.balance', 'DESC'),
+    'name': ('c.client_name', 'ASC'),
+    'unpaid': ('COALESCE(u.unpaid_amount_n, 0)', 'DESC'),
+}
+
 @app.route('/clients')
 def clients():
     """View all clients"""
     if not can('can_view_clients'):
         return redirect(url_for('index'))
     conn = get_db_connection()
-    clients_list = conn.execute('SELECT * FROM clients WHERE model_id = ? ORDER BY balance DESC, client_name', (current_model_id(),)).fetchall()
-    return render_template('clients.html', clients=clients_list)
+    sort = request.args.get('sort', 'balance')
+    if sort not in CLIENT_SORTS:
+        sort = 'balance'
+    column, direction = CLIENT_SORTS[sort]
+    op = '<' if direction == 'DESC' else '>'
+    join, params = '', []
+    if sort == 'unpaid':
+        # Ranking by unpaid needs every client's total; the rollups have them
+        # already grouped by day rather than per transaction
+        join = '''
+            LEFT JOIN (
+                SELECT client_name, SUM(sum_amount_n) AS unpaid_amount_n
+                FROM transaction_rollups
+                WHERE model_id = ? AND is_paid = 0
+                GROUP BY client_name
+            ) u ON u.client_name = c.client_name
+        '''
+        params.append(current_model_id())
+    params.append(current_model_id())
+    where = ''
+    cursor = decode_cursor(request.args.get('after'))
+    if cursor:
+        try:
+            value = cursor[0] if sort == 'name' else float(cursor[0])
+        except ValueError:
+            value = None
+        if value is not None:
+            # The {op}= bound lets the index range start at the cursor
+            where = f'AND {column} {op}= ? AND ({column} {op} ? OR c.id {op} ?)'
+            params += [value, value, cursor[1]]
+    # One query: the page of clients, then the unpaid rollups of just those
+    # clients joined onto it
+    page = conn.execute(f'''
+        WITH page_clients AS (
+            SELECT c.*, {column} AS sort_key
+            FROM clients c
+            {join}
+            WHERE c.model_id = ? {where}
+            ORDER BY sort_key {direction}, c.id {direction}
+            LIMIT ?
+        )
+        SELECT page_clients.*,
+               COALESCE(unpaid.unpaid_count, 0) AS unpaid_count,
+               COALESCE(unpaid.unpaid_amount_n, 0) AS unpaid_amount_n
+        FROM page_clients
+        LEFT JOIN (
+            SELECT client_name, SUM(txn_count) AS unpaid_count, SUM(sum_amount_n) AS unpaid_amount_n
+            FROM transaction_rollups
+            WHERE model_id = ? AND is_paid = 0 AND client_name IN (SELECT client_name FROM page_clients)
+            GROUP BY client_name
+        ) unpaid ON unpaid.client_name = page_clients.client_name
+        ORDER BY page_clients.sort_key {direction}, page_clients.id {direction}
+    ''', params + [PAGE_SIZE + 1, current_model_id()]).fetchall()
+    clients_list, has_more = split_page(page, PAGE_SIZE)
+    next_cursor = encode_cursor(clients_list[-1]['sort_key'], clients_list[-1]['id']) if has_more else None
+    return render_template('clients.html', clients=clients_list, sort=sort,
+                           next_cursor=next_cursor, paged=bool(cursor))
 
 @app.route('/clients/add', methods=['GET', 'POST'])
 def add_client():
@@ -1395,21 +2789,116 @@ def update_balance(client_id):
             pass
         return redirect(url_for('clients'))
 
+def client_transaction_rows(conn, table, live, client_name, cursor, limit):
+    """Up to `limit` of a client's rows in `table` after `cursor`, newest first.
+
+    Undated rows sort last on both backends: dated rows are read first, and
+    undated ones (cursor value '') only once those run out, each with its own
+    keyset so neither query has to sort or skip the rows before the cursor.
+    """
+    params = [current_model_id(), client_name]
+    rows = []
+    if not cursor or cursor[0] != '':
+        keyset, extra = '', []
+        if cursor:
+            keyset = 'AND transaction_date <= ? AND (transaction_date < ? OR id < ?)'
+            extra = [cursor[0], cursor[0], cursor[1]]
+        rows = conn.execute(f'''
+            SELECT * FROM {table}
+            WHERE model_id = ? AND client_name = ? AND {live} AND transaction_date IS NOT NULL {keyset}
+            ORDER BY transaction_date DESC, id DESC
+            LIMIT ?
+        ''', params + extra + [limit]).fetchall()
+    if len(rows) < limit:
+        keyset, extra = ('AND id < ?', [cursor[1]]) if cursor and cursor[0] == '' else ('', [])
+        rows += conn.execute(f'''
+            SELECT * FROM {table}
+            WHERE model_id = ? AND client_name = ? AND {live} AND transaction_date IS NULL {keyset}
+            ORDER BY id DESC
+            LIMIT ?
+        ''', params + extra + [limit - len(rows)]).fetchall()
+    return rows
+
 @app.route('/clients/<int:client_id>/transactions')
 def client_transactions(client_id):
     """View all transactions for a specific client"""
     conn = get_db_connection()
     client = conn.execute('SELECT * FROM clients WHERE id = ? AND model_id = ?', (client_id, current_model_id())).fetchone()
-    transactions = conn.execute('SELECT * FROM transactions WHERE client_name = ? AND model_id = ? AND deleted = 0 ORDER BY transaction_date DESC', (client['client_name'], current_model_id())).fetchall()
-    return render_template('client_transactions.html', client=client, transactions=transactions)
+    if not client:
+        return redirect(url_for('clients'))
+    # Archived transactions (SQLite) are listed and counted too, read-only.
+    # Live and archived rows are paged separately, each on its own client
+    # index, and merged here; going through transactions_all would sort.
+    cursor = decode_cursor(request.args.get('before'))
+    rows = [dict(r, archived=False) for r in client_transaction_rows(
+        conn, 'transactions', 'deleted = 0', client['client_name'], cursor, PAGE_SIZE + 1)]
+    if not POSTGRES_URL:
+        rows += [dict(r, archived=True) for r in client_transaction_rows(
+            conn, 'transactions_archive', 'COALESCE(deleted, 0) = 0', client['client_name'], cursor, PAGE_SIZE + 1)]
+        rows.sort(key=lambda r: (r['transaction_date'] is not None, r['transaction_date'] or '', r['id']), reverse=True)
+    transactions, has_more = split_page(rows, PAGE_SIZE)
+    next_cursor = encode_cursor(transactions[-1]['transaction_date'], transactions[-1]['id']) if has_more else None
+    # Totals come from the rollups (a few rows per day the client was active),
+    # which count archived transactions too
+    summary = conn.execute('''
+        SELECT COALESCE(SUM(txn_count), 0) AS total_count,
+               COALESCE(SUM(sum_amount_n), 0) AS total_amount_n,
+               COALESCE(SUM(CASE WHEN is_paid = 1 THEN txn_count ELSE 0 END), 0) AS paid_count,
+               COALESCE(SUM(CASE WHEN is_paid = 1 THEN sum_amount_n ELSE 0 END), 0) AS paid_amount_n,
+               COALESCE(SUM(CASE WHEN is_paid = 1 THEN 0 ELSE sum_amount_n END), 0) AS unpaid_amount_n
+        FROM transaction_rollups
+        WHERE model_id = ? AND client_name = ?
+    ''', (current_model_id(), client['client_name'])).fetchone()
+    return render_template('client_transactions.html', client=client, transactions=transactions,
+                           summary=summary, next_cursor=next_cursor, paged=bool(cursor))
 
 @app.route('/clients/<int:client_id>/history')
 def balance_history(client_id):
     """View balance history for a client"""
     conn = get_db_connection()
     client = conn.execute('SELECT * FROM clients WHERE id = ? AND model_id = ?', (client_id, current_model_id())).fetchone()
-    history = conn.execute('SELECT * FROM balance_history WHERE client_id = ? AND model_id = ? ORDER BY timestamp DESC', (client_id, current_model_id())).fetchall()
-    return render_template('balance_history.html', client=client, history=history)
+    if not client:
+        return redirect(url_for('clients'))
+    # Running balance: walk back from the client's current balance. Only this
+    # page's rows are read (keyset on the (model_id, client_id, timestamp)
+    # index) and the window sums just them; the balance the page ends on is
+    # handed to the next page alongside the cursor.
+    keyset, params = '', [current_model_id(), client_id]
+    cursor = decode_cursor(request.args.get('before'))
+    start = client['balance'] or 0
+    if cursor:
+        keyset = 'AND (timestamp < ? OR (timestamp = ? AND id < ?))'
+        params += [cursor[0], cursor[0], cursor[1]]
+        try:
+            start = float(request.args['balance'])
+        except (KeyError, ValueError):
+            # Hand-made link without the carried balance: sum the newer entries
+            newer = conn.execute('''
+                SELECT COALESCE(SUM(CASE WHEN type = 'credit' THEN amount ELSE -amount END), 0) AS n
+                FROM balance_history
+                WHERE model_id = ? AND client_id = ? AND (timestamp > ? OR (timestamp = ? AND id >= ?))
+            ''', params).fetchone()['n']
+            start -= newer
+    rows = conn.execute(f'''
+        SELECT page.*,
+               CAST(? AS DOUBLE PRECISION) - COALESCE(SUM(signed_amount) OVER (
+                   ORDER BY timestamp DESC, id DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS running_balance
+        FROM (
+            SELECT bh.*, CASE WHEN type = 'credit' THEN amount ELSE -amount END AS signed_amount
+            FROM balance_history bh
+            WHERE model_id = ? AND client_id = ? {keyset}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ) page
+        ORDER BY timestamp DESC, id DESC
+    ''', [start] + params + [PAGE_SIZE + 1]).fetchall()
+    history, has_more = split_page(rows, PAGE_SIZE)
+    next_cursor = next_balance = None
+    if has_more:
+        next_cursor = encode_cursor(history[-1]['timestamp'], history[-1]['id'])
+        next_balance = history[-1]['running_balance'] - history[-1]['signed_amount']
+    return render_template('balance_history.html', client=client, history=history,
+                           next_cursor=next_cursor, next_balance=next_balance, paged=bool(cursor))
 
 # ==================== COUNTRY ROUTES ====================
 
@@ -1455,14 +2944,116 @@ def add_country():
         
         conn = get_db_connection()
         try:
-            conn.execute('INSERT INTO countries (name, price, continent) VALUES (?, ?, ?)',
-                        (name, price, continent))
+            conn.execute('INSERT INTO countries (name, price, continent) VALUES (?, ?, ?)',
+                        (name, price, continent))
+            bump_cache_version(conn, 'countries')
+            conn.commit()
+            return redirect(url_for('countries'))
+        except sqlite3.IntegrityError:
+            return render_template('add_country.html', error='Country name already exists')
+    
+    return render_template('add_country.html')
+
+CONTINENTS = ['Africa', 'Asia', 'Europe', 'North America', 'South America', 'Oceania', 'Antarctica']
+
+def valid_price(value):
+    return isinstance(value, (int, float)) and math.isfinite(value) and value >= 0
+
+def parse_price_csv(text):
+    """Parse 'name,price' lines (header optional) into [(name, price)] and errors"""
+    rows, errors = [], []
+    for lineno, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if len(row) < 2:
+            errors.append(f'Line {lineno}: expected name,price')
+            continue
+        name, price = row[0].strip(), row[1].strip()
+        try:
+            value = round(float(price.replace(',', '')), 2)
+        except ValueError:
+            if lineno == 1:
+                continue  # header row
+            errors.append(f'Line {lineno}: invalid price "{price}"')
+            continue
+        if not valid_price(value):
+            errors.append(f'Line {lineno}: invalid price "{price}"')
+            continue
+        rows.append((name, value))
+    return rows, errors
+
+def plan_price_changes(catalog, form, files):
+    """Build [{name, continent, old, new}] from a CSV or per-continent percentages"""
+    changes, errors = [], []
+    mode = form.get('mode', 'csv')
+    if mode == 'percent':
+        for continent in CONTINENTS + ['Unknown']:
+            raw = (form.get(f'pct_{continent}') or '').strip()
+            if not raw:
+                continue
+            try:
+                pct = float(raw)
+            except ValueError:
+                pct = None
+            if pct is None or not math.isfinite(pct) or pct < -100:
+                errors.append(f'{continent}: invalid percentage "{raw}"')
+                continue
+            for name, (price, cont) in sorted(catalog.items()):
+                if (cont or 'Unknown') == continent:
+                    new = round(price * (1 + pct / 100.0), 2)
+                    if new != price:
+                        changes.append({'name': name, 'continent': cont, 'old': price, 'new': new})
+    else:
+        text = form.get('csv_text') or ''
+        upload = files.get('csv_file')
+        if upload and upload.filename:
+            text = upload.read().decode('utf-8-sig', errors='replace')
+        rows, errors = parse_price_csv(text)
+        seen = set()
+        for name, new in rows:
+            if name not in catalog:
+                errors.append(f'Unknown country "{name}"')
+                continue
+            if name in seen:
+                continue
+            seen.add(name)
+            price, cont = catalog[name]
+            if new != price:
+                changes.append({'name': name, 'continent': cont, 'old': price, 'new': new})
+    return changes, errors
+
+@app.route('/countries/bulk-prices', methods=['GET', 'POST'])
+def bulk_country_prices():
+    """Preview and apply price changes for many countries at once"""
+    conn = get_db_connection()
+    catalog = country_catalog(conn)
+    if request.method == 'POST' and request.form.get('action') == 'apply':
+        # The change set comes back from the browser, so check every row against
+        # the catalog: a price that moved since the preview means preview again
+        try:
+            changes = json.loads(request.form.get('changes') or '[]')
+            params = []
+            for c in changes:
+                name, old, new = c['name'], float(c['old']), round(float(c['new']), 2)
+                if name not in catalog or not valid_price(new):
+                    raise ValueError(name)
+                if abs(catalog[name][0] - old) > 0.005:
+                    return render_template('bulk_country_prices.html', continents=CONTINENTS,
+                                           error=f'The price of {name} changed since the preview; preview again')
+                params.append((new, name))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return render_template('bulk_country_prices.html', continents=CONTINENTS, error='Invalid change set')
+        if params:
+            conn.executemany('UPDATE countries SET price = ? WHERE name = ?', params)
+            bump_cache_version(conn, 'countries')
             conn.commit()
-            return redirect(url_for('countries'))
-        except sqlite3.IntegrityError:
-            return render_template('add_country.html', error='Country name already exists')
-    
-    return render_template('add_country.html')
+        return redirect(url_for('countries', message=f'Updated {len(params)} country prices'))
+    if request.method == 'POST':
+        changes, errors = plan_price_changes(catalog, request.form, request.files)
+        return render_template('bulk_country_prices.html', continents=CONTINENTS,
+                               changes=changes, errors=errors, form=request.form,
+                               changes_json=json.dumps(changes))
+    return render_template('bulk_country_prices.html', continents=CONTINENTS)
 
 @app.route('/countries/<int:country_id>/edit', methods=['GET', 'POST'])
 def edit_country(country_id):
@@ -1477,6 +3068,7 @@ def edit_country(country_id):
         try:
             conn.execute('UPDATE countries SET name = ?, price = ?, continent = ? WHERE id = ?',
                         (name, price, continent, country_id))
+            bump_cache_version(conn, 'countries')
             conn.commit()
             return redirect(url_for('countries', message='Country updated'))
         except sqlite3.IntegrityError:
@@ -1488,6 +3080,7 @@ def delete_country(country_id):
     """Delete a country"""
     conn = get_db_connection()
     conn.execute('DELETE FROM countries WHERE id = ?', (country_id,))
+    bump_cache_version(conn, 'countries')
     conn.commit()
     return redirect(url_for('countries'))
 
@@ -1499,7 +3092,7 @@ def transactions():
     conn = get_db_connection()
     # available filter options
     clients_list = conn.execute('SELECT client_name FROM clients WHERE model_id = ? ORDER BY client_name', (current_model_id(),)).fetchall()
-    countries_list = conn.execute('SELECT name FROM countries ORDER BY name').fetchall()
+    countries_list = country_list(conn)
 
     # collect filters from query params
     client = request.args.get('client_name')
@@ -1556,7 +3149,7 @@ def transactions():
     # if paid in ('0', '1'):
     #     where_clauses.append('t.is_paid = ?')
     #     params.append(int(paid))
-    where_clauses = ['t.model_id = ?'] + where_clauses
+    where_clauses = ['t.model_id = ?', 't.deleted = 0'] + where_clauses
     params = [current_model_id()] + params
     where_sql = ('WHERE ' + ' AND '.join(where_clauses)) if where_clauses else 'WHERE t.model_id = ?'
 
@@ -1598,8 +3191,7 @@ def add_transaction():
                     app_id = int(request.form['app_id'])
                 except (ValueError, TypeError):
                      return render_template('add_transaction.html', 
-                                         clients=conn.execute('SELECT client_name FROM clients ORDER BY client_name').fetchall(), 
-                                         countries=conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall(),
+                                         countries=country_list(conn),
                                          error='Invalid App ID')
 
                 country_name = request.form['country_name']
@@ -1625,25 +3217,22 @@ def add_transaction():
                         transaction_date = None
                 
                 # Get country price
-                country = conn.execute('SELECT price FROM countries WHERE name = ?', (country_name,)).fetchone()
+                country = country_catalog(conn).get(country_name)
                 if not country:
-                    clients_list = conn.execute('SELECT client_name FROM clients').fetchall()
-                    countries_list = conn.execute('SELECT name FROM countries').fetchall()
+                    countries_list = country_list(conn)
                     return render_template('add_transaction.html', 
-                                         clients=clients_list, 
                                          countries=countries_list,
                                          error='Country not found')
                 
-                country_price = country['price']
+                country_price = country[0]
                 amount = country_price + addition
                 amount_n = amount * rate
                 email_link = request.form.get('email_link', '')
                 
-                exists = conn.execute('SELECT id FROM transactions WHERE app_id = ? AND model_id = ?', (app_id, current_model_id())).fetchone()
+                exists = conn.execute('SELECT id FROM transactions_all WHERE app_id = ? AND model_id = ?', (app_id, current_model_id())).fetchone()
                 if exists:
-                    clients_list = conn.execute('SELECT client_name FROM clients ORDER BY client_name').fetchall()
-                    countries_list = conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall()
-                    return render_template('add_transaction.html', clients=clients_list, countries=countries_list, error='App ID already exists')
+                    countries_list = country_list(conn)
+                    return render_template('add_transaction.html', countries=countries_list, error='App ID already exists')
                 
                 if transaction_date:
                     sql = '''
@@ -1667,20 +3256,27 @@ def add_transaction():
                 else:
                     conn.execute(sql, params)
                     transaction_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                rollup_transaction_change(conn, None, rollup_snapshot(conn, transaction_id))
 
                 conn.commit()
                 return redirect(url_for('transactions'))
             except Exception as e:
                 import traceback
                 import sys
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                if 'unique' in str(e).lower():
+                    # Lost a race with another insert of the same App ID
+                    return render_template('add_transaction.html', countries=country_list(conn), error='App ID already exists')
                 print(f"ERROR in add_transaction: {e}", file=sys.stderr)
                 traceback.print_exc()
                 # Removed file logging for Vercel compatibility
                 return render_template('base.html', error=f'Error processing transaction: {str(e)}'), 500
         
-        clients_list = conn.execute('SELECT client_name FROM clients ORDER BY client_name').fetchall()
-        countries_list = conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall()
-        return render_template('add_transaction.html', clients=clients_list, countries=countries_list)
+        countries_list = country_list(conn)
+        return render_template('add_transaction.html', countries=countries_list)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1697,12 +3293,13 @@ def edit_transaction(transaction_id):
     if request.method == 'POST':
         try:
             # Get original transaction
-            original_transaction = conn.execute('SELECT client_name, amount_n, is_paid, model_id FROM transactions WHERE id = ?', (transaction_id,)).fetchone()
+            original_transaction = conn.execute('SELECT client_name, amount_n, is_paid, model_id FROM transactions WHERE id = ? AND deleted = 0', (transaction_id,)).fetchone()
             if not original_transaction or original_transaction['model_id'] != current_model_id():
                 return redirect(url_for('transactions'))
             original_client_name = original_transaction['client_name']
             original_amount_n = original_transaction['amount_n']
             original_is_paid = int(original_transaction.get('is_paid') or 0)
+            rollup_before = rollup_snapshot(conn, transaction_id)
         
             client_name = request.form['client_name']
             applicant_name = request.form.get('applicant_name', '')
@@ -1742,28 +3339,24 @@ def edit_transaction(transaction_id):
                     transaction_date = None
         
             # Get country price
-            country = conn.execute('SELECT price FROM countries WHERE name = ?', (country_name,)).fetchone()
+            country = country_catalog(conn).get(country_name)
             if not country:
                 transaction = conn.execute('SELECT * FROM transactions WHERE id = ?', (transaction_id,)).fetchone()
-                clients_list = conn.execute('SELECT client_name FROM clients ORDER BY client_name').fetchall()
-                countries_list = conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall()
+                countries_list = country_list(conn)
                 return render_template('edit_transaction.html', 
                                      transaction=transaction,
-                                     clients=clients_list, 
                                      countries=countries_list,
                                      error='Country not found')
         
-            country_price = country['price']
+            country_price = country[0]
             amount = country_price + addition
             amount_n = amount * rate
-            dup = conn.execute('SELECT id FROM transactions WHERE app_id = ? AND model_id = ? AND id != ?', (app_id, current_model_id(), transaction_id)).fetchone()
+            dup = conn.execute('SELECT id FROM transactions_all WHERE app_id = ? AND model_id = ? AND id != ?', (app_id, current_model_id(), transaction_id)).fetchone()
             if dup:
                 transaction = conn.execute('SELECT * FROM transactions WHERE id = ?', (transaction_id,)).fetchone()
-                clients_list = conn.execute('SELECT client_name FROM clients WHERE model_id = ? ORDER BY client_name', (current_model_id(),)).fetchall()
-                countries_list = conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall()
+                countries_list = country_list(conn)
                 return render_template('edit_transaction.html', 
                                      transaction=transaction,
-                                     clients=clients_list, 
                                      countries=countries_list,
                                      error='App ID already exists')
         
@@ -1781,6 +3374,7 @@ def edit_transaction(transaction_id):
                         country_price = ?, rate = ?, addition = ?, amount = ?, amount_n = ?, email_link = ?
                     WHERE id = ?
                 ''', (client_name, email, service_type, applicant_name, app_id, country_name, country_price, rate, addition, amount, amount_n, email_link, transaction_id))
+            rollup_transaction_change(conn, rollup_before, rollup_snapshot(conn, transaction_id))
         
             original_client = conn.execute('SELECT id, balance FROM clients WHERE client_name = ? AND model_id = ?', (original_client_name, current_model_id())).fetchone()
             if original_client and original_is_paid == 1:
@@ -1802,12 +3396,10 @@ def edit_transaction(transaction_id):
                                  (new_client['id'], transaction_id, (amount_n or 0), 'debit', balance_before_new, balance_after_new, description_new, current_model_id()))
             else:
                 transaction = conn.execute('SELECT * FROM transactions WHERE id = ?', (transaction_id,)).fetchone()
-                clients_list = conn.execute('SELECT client_name FROM clients WHERE model_id = ? ORDER BY client_name', (current_model_id(),)).fetchall()
-                countries_list = conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall()
+                countries_list = country_list(conn)
                 conn.rollback()
                 return render_template('edit_transaction.html', 
                                      transaction=transaction,
-                                     clients=clients_list, 
                                      countries=countries_list,
                                      error='Selected client not found in current model')
         
@@ -1826,29 +3418,25 @@ def edit_transaction(transaction_id):
             
             try:
                 transaction = conn.execute('SELECT * FROM transactions WHERE id = ?', (transaction_id,)).fetchone()
-                clients_list = conn.execute('SELECT client_name FROM clients WHERE model_id = ? ORDER BY client_name', (current_model_id(),)).fetchall()
-                countries_list = conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall()
+                countries_list = country_list(conn)
                 
                 return render_template('edit_transaction.html', 
                                      transaction=transaction,
-                                     clients=clients_list, 
                                      countries=countries_list,
-                                     error=f'An unexpected error occurred: {str(e)}')
+                                     error='App ID already exists' if 'unique' in str(e).lower() else f'An unexpected error occurred: {str(e)}')
             except Exception as e2:
                 print(f"CRITICAL ERROR recovering from edit_transaction failure: {e2}", file=sys.stderr)
                 traceback.print_exc()
                 return f"An error occurred: {str(e)}. Additionally, failed to reload form: {str(e2)}", 500
     
-    transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ?', (transaction_id, current_model_id())).fetchone()
-    clients_list = conn.execute('SELECT client_name FROM clients WHERE model_id = ? ORDER BY client_name', (current_model_id(),)).fetchall()
-    countries_list = conn.execute('SELECT name, price FROM countries ORDER BY name').fetchall()
+    transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ? AND deleted = 0', (transaction_id, current_model_id())).fetchone()
+    countries_list = country_list(conn)
     
     if not transaction:
         return redirect(url_for('transactions'))
     
     return render_template('edit_transaction.html', 
                          transaction=transaction, 
-                         clients=clients_list, 
                          countries=countries_list)
 
 @app.route('/health/db')
@@ -1887,7 +3475,7 @@ def pay_transaction(transaction_id):
     conn = get_db_connection()
     
     try:
-        transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ?', (transaction_id, current_model_id())).fetchone()
+        transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ? AND deleted = 0', (transaction_id, current_model_id())).fetchone()
         if not transaction:
             return redirect(url_for('transactions'))
         if transaction['is_paid']:
@@ -1902,6 +3490,7 @@ def pay_transaction(transaction_id):
         balance_after = balance_before - amount_to_deduct
         conn.execute('UPDATE clients SET balance = ? WHERE id = ? AND model_id = ?', (balance_after, client['id'], current_model_id()))
         conn.execute('UPDATE transactions SET is_paid = 1 WHERE id = ?', (transaction_id,))
+        rollup_transaction_change(conn, transaction, rollup_snapshot(conn, transaction_id))
         conn.execute('''
             INSERT INTO balance_history (client_id, transaction_id, amount, type, balance_before, balance_after, description, model_id)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -1928,7 +3517,7 @@ def undo_pay_transaction(transaction_id):
         return redirect(url_for('transactions'))
     conn = get_db_connection()
     try:
-        transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ?', (transaction_id, current_model_id())).fetchone()
+        transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ? AND deleted = 0', (transaction_id, current_model_id())).fetchone()
         if not transaction:
             return redirect(url_for('transactions'))
         if not transaction['is_paid']:
@@ -1941,6 +3530,7 @@ def undo_pay_transaction(transaction_id):
         balance_after = balance_before + amount_to_add
         conn.execute('UPDATE clients SET balance = ? WHERE id = ? AND model_id = ?', (balance_after, client['id'], current_model_id()))
         conn.execute('UPDATE transactions SET is_paid = 0 WHERE id = ?', (transaction_id,))
+        rollup_transaction_change(conn, transaction, rollup_snapshot(conn, transaction_id))
         conn.execute('DELETE FROM balance_history WHERE transaction_id = ?', (transaction_id,))
         conn.commit()
         return redirect(url_for('transactions'))
@@ -1953,6 +3543,12 @@ def undo_pay_transaction(transaction_id):
         except Exception:
             pass
         return redirect(url_for('transactions', error='Failed to undo payment'))
+# DELETE_MODE=tombstone deletes a transaction by flagging the row (deleted = 1,
+# deleted_at) instead of copying it to deleted_transactions, so delete and
+# restore are one-row updates and the id and its balance history survive.
+# The bin lists both kinds, so switching modes never strands a deleted row.
+DELETE_MODE = os.getenv('DELETE_MODE', 'copy')
+
 @app.route('/transactions/<int:transaction_id>/delete', methods=['POST'])
 def delete_transaction(transaction_id):
     """Delete a transaction"""
@@ -1961,14 +3557,25 @@ def delete_transaction(transaction_id):
         return redirect(url_for('transactions'))
     conn = get_db_connection()
     try:
-        transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ?', (transaction_id, current_model_id())).fetchone()
+        transaction = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ? AND deleted = 0', (transaction_id, current_model_id())).fetchone()
         if not transaction:
             return redirect(url_for('transactions'))
+        client = None
         if transaction['is_paid']:
             client = conn.execute('SELECT id, balance FROM clients WHERE client_name = ? AND model_id = ?', (transaction['client_name'], current_model_id())).fetchone()
             if client:
                 new_balance = client['balance'] + (transaction['amount_n'] or 0)
                 conn.execute('UPDATE clients SET balance = ? WHERE id = ? AND model_id = ?', (new_balance, client['id'], current_model_id()))
+        if DELETE_MODE == 'tombstone':
+            conn.execute('UPDATE transactions SET deleted = 1, deleted_at = CURRENT_TIMESTAMP WHERE id = ? AND model_id = ?', (transaction_id, current_model_id()))
+            rollup_transaction_change(conn, transaction, None)
+            if client:
+                # Keep the payment in the history and record its reversal
+                conn.execute('INSERT INTO balance_history (client_id, transaction_id, amount, type, balance_before, balance_after, description, model_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (client['id'], transaction_id, (transaction['amount_n'] or 0), 'credit', client['balance'], new_balance,
+                              f'Transaction {transaction_id} deleted', current_model_id()))
+            conn.commit()
+            return redirect(url_for('transactions'))
         conn.execute('''
             INSERT INTO deleted_transactions (original_id, client_name, email, service_type, applicant_name, app_id, country_name, country_price, rate, addition, amount, amount_n, is_paid, transaction_date, model_id)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -1978,6 +3585,7 @@ def delete_transaction(transaction_id):
             transaction['amount'], transaction['amount_n'], transaction['is_paid'], transaction['transaction_date'], current_model_id()
         ))
         conn.execute('DELETE FROM transactions WHERE id = ? AND model_id = ?', (transaction_id, current_model_id()))
+        rollup_transaction_change(conn, transaction, None)
         conn.execute('DELETE FROM balance_history WHERE transaction_id = ?', (transaction_id,))
         conn.commit()
         return redirect(url_for('transactions'))
@@ -1993,12 +3601,71 @@ def delete_transaction(transaction_id):
         return redirect(url_for('transactions', error='Failed to delete transaction'))
 
 
+# Bin entries older than BIN_RETENTION_DAYS are purged in small batches by a
+# background job, so the table stays small and no purge holds a long lock.
+BIN_RETENTION_DAYS = int(os.getenv('BIN_RETENTION_DAYS', '90'))
+BIN_PURGE_BATCH_SIZE = int(os.getenv('BIN_PURGE_BATCH_SIZE', '200'))
+BIN_PURGE_INTERVAL = int(os.getenv('BIN_PURGE_INTERVAL', '3600'))
+
+@job_handler('purge_bin', every=BIN_PURGE_INTERVAL if BIN_RETENTION_DAYS > 0 else None)
+def purge_bin_job(conn, job, state):
+    if 'cutoff' not in state:
+        # deleted_at defaults to CURRENT_TIMESTAMP, which is UTC on SQLite
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - BIN_RETENTION_DAYS * 86400))
+        total = conn.execute('SELECT COUNT(*) AS n FROM deleted_transactions WHERE deleted_at < ?', (cutoff,)).fetchone()['n']
+        total += conn.execute('SELECT COUNT(*) AS n FROM transactions WHERE deleted = 1 AND deleted_at < ?', (cutoff,)).fetchone()['n']
+        return {'cutoff': cutoff, 'total': total}, 0, False
+    rows = conn.execute('SELECT id FROM deleted_transactions WHERE deleted_at < ? ORDER BY deleted_at LIMIT ?',
+                        (state['cutoff'], BIN_PURGE_BATCH_SIZE)).fetchall()
+    ids = [r['id'] for r in rows]
+    if ids:
+        conn.execute(f"DELETE FROM deleted_transactions WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        return state, len(ids), False
+    # Then tombstoned transactions, with the history that pointed at them
+    rows = conn.execute('SELECT id FROM transactions WHERE deleted = 1 AND deleted_at < ? ORDER BY deleted_at LIMIT ?',
+                        (state['cutoff'], BIN_PURGE_BATCH_SIZE)).fetchall()
+    ids = [r['id'] for r in rows]
+    if not ids:
+        return state, 0, True
+    marks = ', '.join('?' * len(ids))
+    conn.execute(f'DELETE FROM balance_history WHERE transaction_id IN ({marks})', ids)
+    conn.execute(f'DELETE FROM transactions WHERE deleted = 1 AND id IN ({marks})', ids)
+    return state, len(ids), False
+
 @app.route('/transactions/bin')
 def transactions_bin():
-    """View deleted transactions (bin)"""
+    """View deleted transactions (bin), newest first, a page at a time.
+
+    Lists both copies in deleted_transactions and tombstoned transactions;
+    row_key (id * 2, or id * 2 + 1 for tombstones) keeps the cursor unique.
+    """
     conn = get_db_connection()
-    deleted = conn.execute('SELECT * FROM deleted_transactions WHERE model_id = ? ORDER BY deleted_at DESC', (current_model_id(),)).fetchall()
-    return render_template('deleted_transactions.html', deleted=deleted)
+    params = [current_model_id(), current_model_id()]
+    where = ''
+    cursor = decode_cursor(request.args.get('before'))
+    if cursor:
+        where = 'WHERE deleted_at < ? OR (deleted_at = ? AND row_key < ?)'
+        params += [cursor[0], cursor[0], cursor[1]]
+    rows = conn.execute(f'''
+        SELECT * FROM (
+            SELECT id, 'bin' AS source, original_id, client_name, applicant_name, country_name,
+                   amount, amount_n, transaction_date, deleted_at, id * 2 AS row_key
+            FROM deleted_transactions
+            WHERE model_id = ?
+            UNION ALL
+            SELECT id, 'tombstone' AS source, id AS original_id, client_name, applicant_name, country_name,
+                   amount, amount_n, transaction_date, deleted_at, id * 2 + 1 AS row_key
+            FROM transactions
+            WHERE model_id = ? AND deleted = 1
+        ) bin
+        {where}
+        ORDER BY deleted_at DESC, row_key DESC
+        LIMIT ?
+    ''', params + [PAGE_SIZE + 1]).fetchall()
+    deleted, has_more = split_page(rows, PAGE_SIZE)
+    next_cursor = encode_cursor(deleted[-1]['deleted_at'], deleted[-1]['row_key']) if has_more else None
+    return render_template('deleted_transactions.html', deleted=deleted, next_cursor=next_cursor, paged=bool(cursor),
+                           retention_days=BIN_RETENTION_DAYS, error=request.args.get('error'))
 
 
 @app.route('/transactions/bin/<int:deleted_id>/restore', methods=['POST'])
@@ -2022,6 +3689,7 @@ def restore_deleted_transaction(deleted_id):
         else:
             conn.execute(sql, params)
             new_transaction_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        rollup_transaction_change(conn, None, rollup_snapshot(conn, new_transaction_id))
         client = conn.execute('SELECT id, balance FROM clients WHERE client_name = ? AND model_id = ?', (row['client_name'], current_model_id())).fetchone()
         if client and int(row['is_paid'] or 0) == 1:
             balance_before = client['balance']
@@ -2064,6 +3732,301 @@ def permanently_delete_transaction(deleted_id):
             pass
         return redirect(url_for('transactions_bin', error='Failed to permanently delete'))
 
+@app.route('/transactions/<int:transaction_id>/restore', methods=['POST'])
+def restore_transaction(transaction_id):
+    """Bring a tombstoned transaction back under its original id"""
+    perms = session.get('permissions', {})
+    if not perms.get('can_delete_transaction') and not perms.get('is_admin'):
+        return redirect(url_for('transactions_bin'))
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT * FROM transactions WHERE id = ? AND model_id = ? AND deleted = 1', (transaction_id, current_model_id())).fetchone()
+        if not row:
+            return redirect(url_for('transactions_bin'))
+        conn.execute('UPDATE transactions SET deleted = 0, deleted_at = NULL WHERE id = ?', (transaction_id,))
+        rollup_transaction_change(conn, None, rollup_snapshot(conn, transaction_id))
+        client = conn.execute('SELECT id, balance FROM clients WHERE client_name = ? AND model_id = ?', (row['client_name'], current_model_id())).fetchone()
+        if client and int(row['is_paid'] or 0) == 1:
+            balance_before = client['balance']
+            balance_after = balance_before - (row['amount_n'] or 0)
+            conn.execute('UPDATE clients SET balance = ? WHERE id = ? AND model_id = ?', (balance_after, client['id'], current_model_id()))
+            conn.execute('INSERT INTO balance_history (client_id, transaction_id, amount, type, balance_before, balance_after, description, model_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (client['id'], transaction_id, (row['amount_n'] or 0), 'debit', balance_before, balance_after,
+                          f'Restore transaction {transaction_id} for client {row["client_name"]}', current_model_id()))
+        conn.commit()
+        return redirect(url_for('transactions'))
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return redirect(url_for('transactions_bin', error='Failed to restore transaction'))
+
+
+@app.route('/transactions/<int:transaction_id>/purge', methods=['POST'])
+def purge_transaction(transaction_id):
+    """Permanently remove a tombstoned transaction and its balance history"""
+    perms = session.get('permissions', {})
+    if not perms.get('can_delete_transaction') and not perms.get('is_admin'):
+        return redirect(url_for('transactions_bin'))
+    conn = get_db_connection()
+    try:
+        cur = conn.execute('DELETE FROM transactions WHERE id = ? AND model_id = ? AND deleted = 1', (transaction_id, current_model_id()))
+        if cur.rowcount:
+            conn.execute('DELETE FROM balance_history WHERE transaction_id = ? AND model_id = ?', (transaction_id, current_model_id()))
+        conn.commit()
+        return redirect(url_for('transactions_bin'))
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return redirect(url_for('transactions_bin', error='Failed to permanently delete'))
+
+# ==================== SEARCH ====================
+# Transactions are searchable by applicant name, email, client, country and
+# app ID prefix. SQLite uses an external-content FTS5 table kept in sync by
+# triggers and ranked by bm25(); Postgres uses a generated tsvector column
+# with a GIN index, ranked by ts_rank(). On SQLite the index covers live
+# transactions only: rows moved to transactions_archive leave search.
+SEARCH_FIELDS = ['applicant_name', 'email', 'client_name', 'country_name', 'app_id']
+_FTS_COLUMNS = ', '.join(SEARCH_FIELDS)
+_FTS_NEW = ', '.join('new.' + f for f in SEARCH_FIELDS)
+_FTS_OLD = ', '.join('old.' + f for f in SEARCH_FIELDS)
+SQLITE_FTS_SQL = [
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+            {_FTS_COLUMNS}, content='transactions', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2')''',
+    f'''CREATE TRIGGER IF NOT EXISTS transactions_fts_insert AFTER INSERT ON transactions BEGIN
+            INSERT INTO transactions_fts(rowid, {_FTS_COLUMNS}) VALUES (new.id, {_FTS_NEW});
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions BEGIN
+            INSERT INTO transactions_fts(transactions_fts, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.id, {_FTS_OLD});
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE OF {_FTS_COLUMNS} ON transactions BEGIN
+            INSERT INTO transactions_fts(transactions_fts, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.id, {_FTS_OLD});
+            INSERT INTO transactions_fts(rowid, {_FTS_COLUMNS}) VALUES (new.id, {_FTS_NEW});
+        END''',
+]
+PG_SEARCH_VECTOR_SQL = (
+    "tsvector GENERATED ALWAYS AS (to_tsvector('simple', "
+    "coalesce(applicant_name, '') || ' ' || coalesce(email, '') || ' ' || coalesce(client_name, '') || ' ' || "
+    "coalesce(country_name, '') || ' ' || coalesce(app_id::text, ''))) STORED"
+)
+
+def search_terms(q):
+    """Split a query into word tokens, each matched as a prefix"""
+    return re.findall(r'\w+', q or '')[:8]
+
+def search_transactions(conn, model_id, q, limit, offset=0):
+    """Ranked transactions matching every term of `q`, best first"""
+    terms = search_terms(q)
+    if not terms:
+        return []
+    if POSTGRES_URL:
+        tsquery = ' & '.join(f'{t}:*' for t in terms)
+        return conn.execute('''
+            SELECT t.*, ts_rank(t.search_vector, to_tsquery('simple', ?)) AS rank
+            FROM transactions t
+            WHERE t.search_vector @@ to_tsquery('simple', ?) AND t.model_id = ? AND t.deleted = 0
+            ORDER BY rank DESC, t.id DESC
+            LIMIT ? OFFSET ?
+        ''', (tsquery, tsquery, model_id, limit, offset)).fetchall()
+    match = ' '.join(f'"{t}"*' for t in terms)
+    return conn.execute('''
+        SELECT t.*, bm25(transactions_fts) AS rank
+        FROM transactions_fts
+        JOIN transactions t ON t.id = transactions_fts.rowid
+        WHERE transactions_fts MATCH ? AND t.model_id = ? AND t.deleted = 0
+        ORDER BY rank, t.id DESC
+        LIMIT ? OFFSET ?
+    ''', (match, model_id, limit, offset)).fetchall()
+
+@app.route('/search')
+def search():
+    """Search transactions; ranked results are paged by offset"""
+    q = request.args.get('q', '').strip()
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    conn = get_db_connection()
+    rows = search_transactions(conn, current_model_id(), q, PAGE_SIZE + 1, (page - 1) * PAGE_SIZE)
+    results, has_more = split_page(rows, PAGE_SIZE)
+    return render_template('search.html', q=q, results=results, page=page, has_more=has_more)
+
+@app.route('/api/search')
+def api_search():
+    q = request.args.get('q', '').strip()
+    try:
+        limit = min(100, max(1, int(request.args.get('limit', 20))))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        limit, offset = 20, 0
+    rows = search_transactions(get_db_connection(), current_model_id(), q, limit, offset)
+    fields = ['id', 'app_id', 'applicant_name', 'email', 'client_name', 'country_name', 'amount', 'amount_n', 'is_paid']
+    results = []
+    for r in rows:
+        item = {f: r[f] for f in fields}
+        item['transaction_date'] = str(r['transaction_date'])
+        results.append(item)
+    return jsonify({'q': q, 'results': results})
+
+# ==================== REPORTS ====================
+# Grouped totals accept the same filters as the export. Everything except
+# service_type grouping is answered from transaction_rollups; week and month
+# buckets are folded from day rows. /api/reports keeps results for
+# REPORT_CACHE_TTL seconds per (model, group, filters).
+REPORT_GROUPS = ['day', 'week', 'month', 'client', 'country', 'service_type', 'paid']
+REPORT_CACHE_TTL = float(os.getenv('REPORT_CACHE_TTL', '30'))
+REPORT_CACHE_MAX = 256
+_report_cache = {}
+_report_cache_lock = threading.Lock()
+
+def _report_where(filters, date_column, paid_column, timestamps=False):
+    where, params = [], []
+    if filters.get('client_name'):
+        where.append('client_name = ?')
+        params.append(filters['client_name'])
+    if filters.get('country_name'):
+        where.append('country_name = ?')
+        params.append(filters['country_name'])
+    if filters.get('date_from'):
+        where.append(f'{date_column} >= ?')
+        params.append(filters['date_from'])
+    if filters.get('date_to') and timestamps:
+        # A bare timestamp range lets Postgres prune monthly partitions
+        where.append(f'{date_column} < ?')
+        params.append(day_after(filters['date_to']))
+    elif filters.get('date_to'):
+        where.append(f'{date_column} <= ?')
+        params.append(filters['date_to'])
+    if filters.get('paid') in ('0', '1'):
+        where.append(f'{paid_column} = ?')
+        params.append(int(filters['paid']))
+    return where, params
+
+def _report_bucket(group_by, key):
+    # Days that aren't YYYY-MM-DD (missing or odd legacy dates) share one bucket
+    try:
+        day = datetime.strptime(str(key or ''), '%Y-%m-%d')
+    except ValueError:
+        return 'unknown'
+    if group_by == 'week':
+        year, week, _ = day.isocalendar()
+        return f'{year}-W{week:02d}'
+    return day.strftime('%Y-%m')
+
+def build_report(conn, model_id, group_by='day', filters=None):
+    """Grouped totals for one model; returns (rows, source)"""
+    filters = filters or {}
+    if group_by == 'service_type':
+        source = 'transactions'
+        where, params = _report_where(filters, 'transaction_date', 'COALESCE(is_paid, 0)', timestamps=True)
+        where = ['model_id = ?', 'COALESCE(deleted, 0) = 0'] + where
+        sql = f'''
+            SELECT COALESCE(service_type, '') AS group_key,
+                   COUNT(*) AS count,
+                   SUM(amount) AS amount,
+                   SUM(amount_n) AS amount_n,
+                   SUM(CASE WHEN is_paid = 1 THEN amount_n ELSE 0 END) AS paid_amount_n,
+                   SUM(CASE WHEN is_paid = 1 THEN 0 ELSE amount_n END) AS unpaid_amount_n
+            FROM transactions_all
+            WHERE {' AND '.join(where)}
+            GROUP BY COALESCE(service_type, '')
+            ORDER BY 1
+        '''
+    else:
+        source = 'rollups'
+        column = {'client': 'client_name', 'country': 'country_name', 'paid': 'is_paid'}.get(group_by, 'day')
+        where, params = _report_where(filters, 'day', 'is_paid')
+        where = ['model_id = ?'] + where
+        sql = f'''
+            SELECT {column} AS group_key,
+                   SUM(txn_count) AS count,
+                   SUM(sum_amount) AS amount,
+                   SUM(sum_amount_n) AS amount_n,
+                   SUM(CASE WHEN is_paid = 1 THEN sum_amount_n ELSE 0 END) AS paid_amount_n,
+                   SUM(CASE WHEN is_paid = 1 THEN 0 ELSE sum_amount_n END) AS unpaid_amount_n
+            FROM transaction_rollups
+            WHERE {' AND '.join(where)}
+            GROUP BY {column}
+            ORDER BY {column}
+        '''
+    groups = {}
+    for r in conn.execute(sql, [model_id] + params).fetchall():
+        key = _report_bucket(group_by, r['group_key']) if group_by in ('week', 'month') else r['group_key']
+        acc = groups.setdefault(key, {'key': key, 'count': 0, 'amount': 0.0, 'amount_n': 0.0,
+                                      'paid_amount_n': 0.0, 'unpaid_amount_n': 0.0})
+        acc['count'] += int(r['count'] or 0)
+        for field in ('amount', 'amount_n', 'paid_amount_n', 'unpaid_amount_n'):
+            acc[field] += r[field] or 0
+    rows = list(groups.values())
+    for row in rows:
+        for field in ('amount', 'amount_n', 'paid_amount_n', 'unpaid_amount_n'):
+            row[field] = round(row[field], 2)
+    return rows, source
+
+def cached_report(conn, model_id, group_by, filters):
+    """build_report behind a short per-worker TTL cache; returns (rows, source, cached)"""
+    key = (model_id, group_by, tuple(sorted(filters.items())))
+    now = time.monotonic()
+    with _report_cache_lock:
+        hit = _report_cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1], hit[2], True
+    rows, source = build_report(conn, model_id, group_by, filters)
+    with _report_cache_lock:
+        if len(_report_cache) >= REPORT_CACHE_MAX:
+            for k in [k for k, v in _report_cache.items() if v[0] <= now] or list(_report_cache)[:REPORT_CACHE_MAX // 4]:
+                _report_cache.pop(k, None)
+        _report_cache[key] = (now + REPORT_CACHE_TTL, rows, source)
+    return rows, source, False
+
+def report_args():
+    """group_by and the export-style filters from the query string"""
+    group_by = request.args.get('group_by', 'day')
+    if group_by not in REPORT_GROUPS:
+        group_by = 'day'
+    filters = {}
+    for name in ('client_name', 'country_name', 'date_from', 'date_to', 'paid'):
+        value = request.args.get(name, '').strip()
+        if value and value != 'None' and not (name == 'paid' and value == 'all'):
+            filters[name] = value
+    return group_by, filters
+
+@app.route('/reports')
+def reports():
+    """Totals grouped by period, client, country, service or paid status"""
+    conn = get_db_connection()
+    group_by, filters = report_args()
+    rows, _ = build_report(conn, current_model_id(), group_by, filters)
+    totals = {k: sum(r[k] for r in rows) for k in ('count', 'amount', 'amount_n', 'paid_amount_n', 'unpaid_amount_n')}
+    clients_list = conn.execute('SELECT client_name FROM clients WHERE model_id = ? ORDER BY client_name', (current_model_id(),)).fetchall()
+    return render_template('reports.html', rows=rows, totals=totals, group_by=group_by, groups=REPORT_GROUPS,
+                           filters=filters, clients=clients_list, countries=country_list(conn))
+
+@app.route('/api/reports')
+def api_reports():
+    conn = get_db_connection()
+    group_by, filters = report_args()
+    rows, source, cached = cached_report(conn, current_model_id(), group_by, filters)
+    response = jsonify({'group_by': group_by, 'filters': filters, 'source': source, 'cached': cached, 'rows': rows})
+    response.cache_control.private = True
+    response.cache_control.max_age = int(REPORT_CACHE_TTL)
+    return response
+
+@app.route('/reports/rebuild', methods=['POST'])
+def rebuild_reports():
+    if not can('is_admin'):
+        return redirect(url_for('reports'))
+    rebuild_rollups(get_db_connection(), current_model_id())
+    return redirect(url_for('reports', message='Rollups rebuilt'))
+
 # ==================== EXPORT ROUTES ====================
 
 @app.route('/transactions/export')
@@ -2082,7 +4045,7 @@ def export_transactions():
         if date_to == 'None': date_to = ''
         
         # Build WHERE clause
-        where_clauses = ['model_id = ?']
+        where_clauses = ['model_id = ?', 'deleted = 0']
         params = [current_model_id()]
         if client:
             where_clauses.append('client_name = ?')
@@ -2091,11 +4054,11 @@ def export_transactions():
             where_clauses.append('country_name = ?')
             params.append(country)
         if date_from:
-            where_clauses.append("date(transaction_date) >= date(?)")
+            where_clauses.append('transaction_date >= ?')
             params.append(date_from)
         if date_to:
-            where_clauses.append("date(transaction_date) <= date(?)")
-            params.append(date_to)
+            where_clauses.append('transaction_date < ?')
+            params.append(day_after(date_to))
         
         if paid in ('0', '1'):
             where_clauses.append('is_paid = ?')
@@ -2105,14 +4068,14 @@ def export_transactions():
         
         conn = get_db_connection()
         transactions_list = conn.execute(f'''
-            SELECT * FROM transactions
+            SELECT * FROM transactions_all
             {where_sql}
             ORDER BY transaction_date DESC
         ''', params).fetchall()
         
         sums = conn.execute(f'''
             SELECT COALESCE(SUM(amount),0) AS sum_amount, COALESCE(SUM(amount_n),0) AS sum_amount_n
-            FROM transactions
+            FROM transactions_all
             {where_sql}
         ''', params).fetchone()
         
@@ -2365,14 +4328,65 @@ def export_jpeg(transactions, sums):
 
 # ==================== API ROUTES ====================
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    if prometheus_client is None:
+        return jsonify({'error': 'prometheus_client is not installed'}), 501
+    # Scrapers authenticate with METRICS_TOKEN; without one only admins can look
+    header = request.headers.get('Authorization') or ''
+    if not (METRICS_TOKEN and secrets.compare_digest(header, f'Bearer {METRICS_TOKEN}')) and not can('is_admin'):
+        if not METRICS_TOKEN:
+            return jsonify({'error': 'Not found'}), 404
+        return jsonify({'error': 'Unauthorized'}), 401
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return app.response_class(prometheus_client.generate_latest(registry),
+                              mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+@app.route('/api/countries')
+def api_countries():
+    """Full country catalog, revalidated with a strong ETag.
+
+    With ?q= returns only the countries starting with q, for typeahead pickers.
+    """
+    conn = get_db_connection()
+    if 'q' in request.args:
+        matches = country_prefix_matches(conn, request.args['q'], typeahead_limit())
+        return jsonify({'results': [{'value': c['name'], 'text': c['name'], 'price': c['price'], 'continent': c['continent']}
+                                    for c in matches]})
+    countries_list = country_list(conn)
+    version = g.get('country_catalog_version')
+    if version is None:
+        etag = hashlib.sha1(json.dumps(countries_list, sort_keys=True).encode()).hexdigest()
+    else:
+        etag = f'countries-v{version}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({'version': version, 'countries': countries_list})
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/clients')
+def api_clients():
+    """Typeahead: clients of the current model whose name starts with q"""
+    conn = get_db_connection()
+    rows = client_prefix_matches(conn, current_model_id(), request.args.get('q', ''), typeahead_limit())
+    return jsonify({'results': [{'value': r['client_name'], 'text': r['client_name']} for r in rows]})
+
 @app.route('/api/countries/<country_name>/price')
 def get_country_price(country_name):
     """API endpoint to get country price"""
     conn = get_db_connection()
-    country = conn.execute('SELECT price FROM countries WHERE name = ?', (country_name,)).fetchone()
+    country = country_catalog(conn).get(country_name)
     
     if country:
-        return jsonify({'price': country['price']})
+        return jsonify({'price': country[0]})
     return jsonify({'error': 'Country not found'}), 404
 
 @app.errorhandler(500)
@@ -2535,6 +4549,13 @@ def internal_server_error(error):
     import traceback
     return f"<pre>{traceback.format_exc()}</pre>", 500
 
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    message = getattr(error, 'description', None) or 'Upload is too large'
+    if request.args.get('preview') == '1':
+        return jsonify({'error': message}), 413
+    return render_template('base.html', error=message), 413
+
 @app.route('/image-processing', methods=['GET', 'POST'])
 def image_processing():
     if request.method == 'POST':
@@ -2546,9 +4567,8 @@ def image_processing():
         
         if file:
             try:
-                # Read image
-                img_bytes = file.read()
-                img = Image.open(io.BytesIO(img_bytes))
+                # Header-only size check before anything is decoded
+                img = open_upload_image(file, 'image_processing')
                 
                 action = request.form.get('action')
                 pipeline_json = request.form.get('pipeline')
@@ -2732,6 +4752,8 @@ def image_processing():
                     })
                 return render_template('image_processing.html', processed_image=img_str, format=format_to_save.lower())
                         
+            except RequestEntityTooLarge:
+                raise
             except Exception as e:
                 import traceback
                 traceback.print_exc()
@@ -2741,45 +4763,61 @@ def image_processing():
                         
     return render_template('image_processing.html')
 
+BARCODE_CACHE_SIZE = int(os.getenv('BARCODE_CACHE_SIZE', '512'))
+BARCODE_BATCH_MAX = int(os.getenv('BARCODE_BATCH_MAX', '500'))
+CODE_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+@functools.lru_cache(maxsize=BARCODE_CACHE_SIZE)
+def render_code(code_type, data, output='png', box_size=10, border=4):
+    """Render a QR code or Code 128 barcode to PNG or SVG bytes.
+
+    Results are cached per (type, data, options), so generating the same
+    payload again costs a dictionary lookup. SVG output skips rasterising.
+    """
+    img_io = io.BytesIO()
+    if code_type == 'qrcode':
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=box_size,
+            border=border,
+        )
+        qr.add_data(data)
+        qr.make(fit=True)
+        if output == 'svg':
+            img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+            img.save(img_io)
+        else:
+            img = qr.make_image(fill_color="black", back_color="white")
+            img.save(img_io, 'PNG')
+    elif code_type == 'code128':
+        code128 = barcode.get_barcode_class('code128')
+        my_barcode = code128(data, writer=SVGWriter() if output == 'svg' else ImageWriter())
+        my_barcode.write(img_io)
+    else:
+        raise ValueError(f'Unknown code type: {code_type}')
+    return img_io.getvalue()
+
 @app.route('/tools/barcode-generator', methods=['GET', 'POST'])
 def barcode_generator():
     generated_image = None
     data = ''
     code_type = 'qrcode'
+    output = 'png'
     error = None
 
     if request.method == 'POST':
         data = request.form.get('data', '').strip()
         code_type = request.form.get('type', 'qrcode')
+        output = request.form.get('output', 'png')
+        if output not in CODE_MIMETYPES:
+            output = 'png'
         
         if not data:
             error = "Please enter text or data."
         else:
             try:
-                img_io = io.BytesIO()
-                
-                if code_type == 'qrcode':
-                    qr = qrcode.QRCode(
-                        version=1,
-                        error_correction=qrcode.constants.ERROR_CORRECT_L,
-                        box_size=10,
-                        border=4,
-                    )
-                    qr.add_data(data)
-                    qr.make(fit=True)
-                    img = qr.make_image(fill_color="black", back_color="white")
-                    img.save(img_io, 'PNG')
-                
-                elif code_type == 'code128':
-                    # barcode
-                    code128 = barcode.get_barcode_class('code128')
-                    # writer=ImageWriter() ensures it returns an image, not SVG
-                    my_barcode = code128(data, writer=ImageWriter())
-                    my_barcode.write(img_io)
-                
-                img_io.seek(0)
-                generated_image = base64.b64encode(img_io.getvalue()).decode('utf-8')
-                
+                generated_image = base64.b64encode(render_code(code_type, data, output)).decode('utf-8')
             except Exception as e:
                 import traceback
                 traceback.print_exc()
@@ -2789,8 +4827,607 @@ def barcode_generator():
                            generated_image=generated_image, 
                            data=data, 
                            code_type=code_type, 
+                           output=output,
+                           mimetype=CODE_MIMETYPES[output],
                            error=error)
 
+@app.route('/tools/barcode-generator/batch', methods=['POST'])
+def barcode_batch():
+    """Generate codes for many app IDs of the current model as a ZIP or a PDF sheet"""
+    code_type = request.form.get('type', 'qrcode')
+    fmt = request.form.get('format', 'pdf')
+    if fmt not in ('pdf', 'zip'):
+        return render_template('barcode_generator.html', data='', code_type=code_type, output='png',
+                               mimetype=CODE_MIMETYPES['png'], error='Format must be PDF or ZIP'), 400
+    output = request.form.get('output', 'png')
+    if output not in CODE_MIMETYPES or fmt == 'pdf':
+        output = 'png'
+    date = (request.form.get('date') or '').strip()
+    app_ids = []
+    for token in re.split(r'[\s,;]+', request.form.get('app_ids', '')):
+        if token.isdigit() and int(token) not in app_ids:
+            app_ids.append(int(token))
+
+    conn = get_db_connection()
+    rows = []
+    for i in range(0, len(app_ids), 500):
+        chunk = app_ids[i:i + 500]
+        placeholders = ', '.join('?' for _ in chunk)
+        rows.extend(conn.execute(f'SELECT app_id, applicant_name FROM transactions WHERE model_id = ? AND deleted = 0 AND app_id IN ({placeholders})',
+                                 [current_model_id()] + chunk).fetchall())
+    if date:
+        rows.extend(conn.execute('SELECT app_id, applicant_name FROM transactions WHERE model_id = ? AND deleted = 0 AND DATE(transaction_date) = DATE(?) ORDER BY transaction_date',
+                                 (current_model_id(), date)).fetchall())
+    # Keep the order the app IDs were entered in, then the day's rows
+    order = {a: i for i, a in enumerate(app_ids)}
+    seen = set()
+    items = []
+    for row in sorted(rows, key=lambda r: order.get(int(r['app_id']), len(order))):
+        if row['app_id'] not in seen:
+            seen.add(row['app_id'])
+            items.append((str(row['app_id']), row['applicant_name'] or ''))
+    if not items:
+        return render_template('barcode_generator.html', data='', code_type=code_type, output='png',
+                               mimetype=CODE_MIMETYPES['png'], error='No matching app IDs in the current model')
+    if len(items) > BARCODE_BATCH_MAX:
+        return render_template('barcode_generator.html', data='', code_type=code_type, output='png',
+                               mimetype=CODE_MIMETYPES['png'], error=f'At most {BARCODE_BATCH_MAX} codes per batch')
+
+    with ThreadPoolExecutor(max_workers=PDF_WORKERS) as pool:
+        images = list(pool.map(lambda item: render_code(code_type, item[0], output), items))
+
+    out_path = scratch_path('.' + fmt)
+    try:
+        if fmt == 'zip':
+            with zipfile.ZipFile(out_path, 'w') as zf:
+                for (app_id, _), img in zip(items, images):
+                    zf.writestr(f'{app_id}.{output}', img)
+            mimetype = 'application/zip'
+        else:
+            from reportlab.lib.utils import ImageReader
+            c = canvas.Canvas(out_path, pagesize=A4)
+            page_w, page_h = A4
+            cols, rows_per_page = (3, 6) if code_type == 'qrcode' else (2, 8)
+            cell_w = (page_w - inch) / cols
+            cell_h = (page_h - inch) / rows_per_page
+            for n, ((app_id, applicant), img) in enumerate(zip(items, images)):
+                if n and n % (cols * rows_per_page) == 0:
+                    c.showPage()
+                slot = n % (cols * rows_per_page)
+                x = inch / 2 + (slot % cols) * cell_w
+                y = page_h - inch / 2 - (slot // cols + 1) * cell_h
+                c.drawImage(ImageReader(io.BytesIO(img)), x + 6, y + 24, cell_w - 12, cell_h - 30,
+                            preserveAspectRatio=True, anchor='c')
+                c.setFont('Helvetica', 8)
+                c.drawCentredString(x + cell_w / 2, y + 14, app_id)
+                c.drawCentredString(x + cell_w / 2, y + 4, applicant[:40])
+            c.save()
+            mimetype = 'application/pdf'
+    except BaseException:
+        remove_file(out_path)
+        raise
+    return send_scratch_file(out_path, as_attachment=True, download_name=f'codes.{fmt}', mimetype=mimetype)
+
+# ==================== PDF HELPERS ====================
+
+SCRATCH_DIR = os.getenv('SCRATCH_DIR') or os.path.join(tempfile.gettempdir(), 'ledger-scratch')
+
+def scratch_path(suffix=''):
+    """Create an empty file in the scratch directory and return its path"""
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=SCRATCH_DIR)
+    os.close(fd)
+    return path
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def send_scratch_file(path, **kwargs):
+    """Stream a scratch file from disk and delete it once the response is closed"""
+    response = send_file(path, **kwargs)
+    response.call_on_close(lambda: remove_file(path))
+    return response
+
+class StreamingPdfWriter:
+    """Minimal PDF writer that appends one image page at a time.
+
+    Every object is written out as soon as its page is added, so memory use is
+    bounded by a single page. Object 1 is the catalog and object 2 the page
+    tree; both are written on close() once all page ids are known.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.pos = 0
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.pos += len(data)
+
+    def _begin(self, obj_id):
+        self.offsets[obj_id] = self.pos
+        self._write(f'{obj_id} 0 obj\n'.encode())
+
+    def _object(self, obj_id, body):
+        self._begin(obj_id)
+        self._write(body.encode() + b'\nendobj\n')
+
+    def _stream(self, obj_id, header, stream, length):
+        self._begin(obj_id)
+        self._write(f'<< {header} /Length {length} >>\nstream\n'.encode())
+        shutil.copyfileobj(stream, self.fp, 64 * 1024)
+        self.pos += length
+        self._write(b'\nendstream\nendobj\n')
+
+    def add_image_page(self, stream, length, width, height, colorspace, page_width, page_height):
+        """Add a page showing one DCT (JPEG) encoded image scaled to the page"""
+        image_id, content_id, page_id = self.next_id, self.next_id + 1, self.next_id + 2
+        self.next_id += 3
+        self._stream(image_id,
+                     f'/Type /XObject /Subtype /Image /Width {width} /Height {height} '
+                     f'/ColorSpace /{colorspace} /BitsPerComponent 8 /Filter /DCTDecode',
+                     stream, length)
+        content = f'q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q'.encode()
+        self._stream(content_id, '', io.BytesIO(content), len(content))
+        self._object(page_id,
+                     f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.2f} {page_height:.2f}] '
+                     f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>')
+        self.page_ids.append(page_id)
+
+    def close(self):
+        kids = ' '.join(f'{pid} 0 R' for pid in self.page_ids)
+        self._object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>')
+        self._object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        xref_pos = self.pos
+        size = self.next_id
+        lines = [f'xref\n0 {size}\n', '0000000000 65535 f \n']
+        for obj_id in range(1, size):
+            lines.append(f'{self.offsets.get(obj_id, 0):010d} 00000 n \n')
+        lines.append(f'trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_pos}\n%%EOF\n')
+        self._write(''.join(lines).encode())
+
+def _pdf_object_key(obj):
+    """Content key for a writer object, or None if it should never be merged"""
+    if isinstance(obj, StreamObject):
+        data = getattr(obj, '_data', b'') or b''
+    elif isinstance(obj, DictionaryObject) and obj.get('/Type') in ('/Font', '/FontDescriptor'):
+        data = b''
+    else:
+        return None
+    items = []
+    for k in sorted(obj.keys()):
+        if k == '/Length':
+            continue
+        v = obj[k]
+        items.append((k, ('ref', v.idnum) if isinstance(v, IndirectObject) else repr(v)))
+    return hashlib.sha256(repr(items).encode() + b'\0' + bytes(data)).hexdigest()
+
+def _remap_pdf_references(obj, remap, writer):
+    if isinstance(obj, DictionaryObject):
+        items = obj.items()
+    elif isinstance(obj, ArrayObject):
+        items = enumerate(obj)
+    else:
+        return
+    for k, v in list(items):
+        if isinstance(v, IndirectObject):
+            if v.idnum in remap:
+                obj[k] = IndirectObject(remap[v.idnum], 0, writer)
+        else:
+            _remap_pdf_references(v, remap, writer)
+
+def dedupe_pdf_objects(writer, max_passes=3):
+    """Merge byte-identical streams, fonts and font descriptors in a PdfWriter.
+
+    Inputs that share fonts or images (letterheads, scanner stamps) otherwise
+    carry one copy per input. References to duplicates are pointed at the
+    first copy and the duplicate is replaced by a null object. Runs a few
+    passes so parents become identical once their children have been merged.
+    Returns the number of objects removed.
+    """
+    removed = 0
+    for _ in range(max_passes):
+        seen = {}
+        remap = {}
+        for index, obj in enumerate(writer._objects):
+            key = _pdf_object_key(obj)
+            if key is None:
+                continue
+            if key in seen:
+                remap[index + 1] = seen[key]
+            else:
+                seen[key] = index + 1
+        if not remap:
+            break
+        for obj in writer._objects:
+            _remap_pdf_references(obj, remap, writer)
+        for idnum in remap:
+            writer._objects[idnum - 1] = NullObject()
+        removed += len(remap)
+    return removed
+
+def drop_orphan_objects(writer):
+    """Null out writer objects that can no longer be reached from the catalog"""
+    reachable = set()
+    stack = [writer._root, writer._info]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.pdf is not writer or obj.idnum in reachable:
+                continue
+            reachable.add(obj.idnum)
+            stack.append(writer._objects[obj.idnum - 1])
+        elif isinstance(obj, DictionaryObject):
+            stack.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            stack.extend(obj)
+    removed = 0
+    for index, obj in enumerate(writer._objects):
+        if index + 1 not in reachable and obj is not None and not isinstance(obj, NullObject):
+            writer._objects[index] = NullObject()
+            removed += 1
+    return removed
+
+# Image re-encoding settings per compress_pdf level; 'lossless' leaves images alone
+PDF_COMPRESS_LEVELS = {
+    'lossless': None,
+    'low': {'dpi': 200, 'quality': 85},
+    'medium': {'dpi': 150, 'quality': 70},
+    'high': {'dpi': 100, 'quality': 50},
+}
+PDF_COMPRESS_DEFAULT_LEVEL = os.getenv('PDF_COMPRESS_DEFAULT_LEVEL', 'medium')
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+def _pdf_image_mode(xobj):
+    """PIL mode for an 8-bit gray/RGB image XObject, or None if unsupported"""
+    if xobj.get('/ImageMask') or xobj.get('/BitsPerComponent', 8) != 8:
+        return None
+    cs = xobj.get('/ColorSpace')
+    cs = cs.get_object() if cs is not None else None
+    if isinstance(cs, ArrayObject) and len(cs) == 2 and cs[0] == '/ICCBased':
+        components = cs[1].get_object().get('/N')
+        return {1: 'L', 3: 'RGB'}.get(components)
+    return {'/DeviceGray': 'L', '/DeviceRGB': 'RGB'}.get(cs)
+
+def _pdf_image_filter(xobj):
+    """The filter that defines the image encoding, ignoring ASCII/Flate wrappers"""
+    f = xobj.get('/Filter')
+    if isinstance(f, ArrayObject):
+        if not f or any(x not in ('/ASCII85Decode', '/ASCIIHexDecode', '/FlateDecode') for x in f[:-1]):
+            return '/Unsupported'
+        f = f[-1]
+    return f
+
+def _recompress_pdf_image(xobj, scale, quality):
+    """Decode, downsample and JPEG-encode one image XObject.
+
+    Returns (jpeg_bytes, width, height) or None when the image is unsupported
+    or re-encoding would not make it smaller. Only touches the given object,
+    so several images can be processed at once.
+    """
+    mode = _pdf_image_mode(xobj)
+    pdf_filter = _pdf_image_filter(xobj)
+    if mode is None or pdf_filter not in (None, '/FlateDecode', '/DCTDecode'):
+        return None
+    size = (int(xobj['/Width']), int(xobj['/Height']))
+    original = xobj.get_data()
+    if pdf_filter == '/DCTDecode':
+        img = Image.open(io.BytesIO(original))
+        if img.mode != mode:
+            return None
+        if scale < 1.0:
+            img.draft(mode, (int(size[0] * scale), int(size[1] * scale)))
+    else:
+        if xobj.get('/DecodeParms') and pdf_filter is None:
+            return None
+        img = Image.frombytes(mode, size, original)
+    if scale < 1.0:
+        new_size = (max(1, int(size[0] * scale)), max(1, int(size[1] * scale)))
+        img = img.resize(new_size, Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality, optimize=True)
+    encoded = out.getvalue()
+    if len(encoded) >= len(getattr(xobj, '_data', b'') or b''):
+        return None
+    return encoded, img.size[0], img.size[1]
+
+_CONTENT_NAME_RE = re.compile(rb'/([^\s/\[\]<>(){}%]+)\s+(?:Do\b|[-+\d.]+\s+Tf\b)')
+
+def _prune_page_resources(page):
+    """Drop XObject and Font entries the page content never uses"""
+    resources = page.get('/Resources')
+    contents = page.get_contents()
+    if resources is None or isinstance(resources, IndirectObject) or contents is None:
+        return
+    used = {b'/' + m for m in _CONTENT_NAME_RE.findall(contents.get_data())}
+    for category in ('/XObject', '/Font'):
+        entries = resources.get(category)
+        # Shared (indirect) dictionaries may be used by other pages too
+        if entries is None or isinstance(entries, IndirectObject):
+            continue
+        for name in list(entries.keys()):
+            if name.encode() not in used:
+                del entries[name]
+
+def compress_pdf_file(src, dst, level):
+    """Compress the PDF read from src into the file object dst.
+
+    Embedded 8-bit gray/RGB images are downsampled to the level's DPI and
+    re-encoded as JPEG in parallel, identical objects are merged, unused page
+    resources and unreachable objects are dropped, and content streams are
+    Flate-compressed. Returns a dict of counters for reporting.
+    """
+    settings = PDF_COMPRESS_LEVELS[level]
+    writer = PdfWriter(clone_from=PdfReader(src))
+    stats = {'images': 0, 'images_recompressed': 0, 'objects_removed': 0}
+
+    for page in writer.pages:
+        _prune_page_resources(page)
+
+    if settings:
+        # Effective DPI of each image XObject, taken from the page it is drawn on.
+        # Shared images keep the smallest downsampling factor across pages.
+        scales = {}
+        for page in writer.pages:
+            resources = page.get('/Resources')
+            xobjects = resources.get_object().get('/XObject') if resources is not None else None
+            if xobjects is None:
+                continue
+            page_w_in = float(page.mediabox.width) / 72.0 or 1.0
+            page_h_in = float(page.mediabox.height) / 72.0 or 1.0
+            for ref in xobjects.get_object().values():
+                if not isinstance(ref, IndirectObject):
+                    continue
+                xobj = ref.get_object()
+                if xobj.get('/Subtype') != '/Image':
+                    continue
+                dpi = max(xobj['/Width'] / page_w_in, xobj['/Height'] / page_h_in)
+                scale = min(1.0, settings['dpi'] / dpi) if dpi else 1.0
+                scales[ref.idnum] = max(scale, scales.get(ref.idnum, 0.0))
+        stats['images'] = len(scales)
+
+        def work(idnum):
+            try:
+                return idnum, _recompress_pdf_image(writer._objects[idnum - 1], scales[idnum], settings['quality'])
+            except Exception:
+                return idnum, None
+
+        with ThreadPoolExecutor(max_workers=PDF_WORKERS) as pool:
+            results = list(pool.map(work, scales))
+        for idnum, result in results:
+            if result is None:
+                continue
+            data, width, height = result
+            old = writer._objects[idnum - 1]
+            new = DecodedStreamObject()
+            for key, value in old.items():
+                if key not in ('/Filter', '/DecodeParms', '/Length', '/Width', '/Height'):
+                    new[NameObject(key)] = value
+            new[NameObject('/Filter')] = NameObject('/DCTDecode')
+            new[NameObject('/Width')] = NumberObject(width)
+            new[NameObject('/Height')] = NumberObject(height)
+            new.set_data(data)
+            writer._objects[idnum - 1] = new
+            stats['images_recompressed'] += 1
+
+    for page in writer.pages:
+        page.compress_content_streams()
+    stats['objects_removed'] += dedupe_pdf_objects(writer)
+    stats['objects_removed'] += drop_orphan_objects(writer)
+    writer.add_metadata({})
+    writer.write(dst)
+    writer.close()
+    return stats
+
+# ==================== BACKGROUND PDF TO WORD ====================
+# Conversions run on a small thread pool. Each job lives in its own directory
+# under SCRATCH_DIR/word named by a random id, with a status.json next to the
+# files, so any worker can report on or serve a job until it expires. Finished
+# documents are also kept in SCRATCH_DIR/word/cache under the SHA-256 of the
+# PDF for WORD_JOB_TTL, and a new job for the same PDF links to that copy
+# instead of converting again.
+WORD_JOBS_DIR = os.path.join(SCRATCH_DIR, 'word')
+WORD_CACHE_DIR = os.path.join(WORD_JOBS_DIR, 'cache')
+WORD_JOB_TTL = int(os.getenv('WORD_JOB_TTL', '3600'))
+WORD_JOB_TIMEOUT = int(os.getenv('WORD_JOB_TIMEOUT', '900'))
+# pdf2docx's multi_processing splits the start/end page range into one chunk
+# per process and stitches the parsed pages back into a single document.
+# PDFs of more than one page use up to this many processes, every CPU by
+# default. Those processes hand their pages back through pages-<n>.json in
+# the working directory, so multi-process conversions take turns; each one
+# keeps every CPU busy anyway.
+PDF2DOCX_PROCESSES = int(os.getenv('PDF2DOCX_PROCESSES') or os.cpu_count() or 1)
+_word_pages_lock = threading.Lock()
+_word_executor = ThreadPoolExecutor(max_workers=int(os.getenv('WORD_WORKERS', '2')))
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def _word_job_dir(job_id):
+    if not _JOB_ID_RE.match(job_id or ''):
+        return None
+    return os.path.join(WORD_JOBS_DIR, job_id)
+
+def read_word_job(job_id):
+    """Return the status dict of a conversion job, or None if it is unknown or expired"""
+    job_dir = _word_job_dir(job_id)
+    if not job_dir:
+        return None
+    try:
+        with open(os.path.join(job_dir, 'status.json')) as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    age = time.time() - job.get('updated', 0)
+    if job['status'] == 'done' and age > WORD_JOB_TTL:
+        return None
+    if job['status'] in ('queued', 'running') and age > WORD_JOB_TIMEOUT:
+        job['status'] = 'failed'
+        job['error'] = 'Conversion timed out'
+    return job
+
+def _write_word_job(job_id, **fields):
+    job_dir = _word_job_dir(job_id)
+    path = os.path.join(job_dir, 'status.json')
+    try:
+        with open(path) as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        job = {'id': job_id}
+    job.update(fields, updated=time.time())
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp, path)
+    return job
+
+def _word_cache_path(sha256):
+    return os.path.join(WORD_CACHE_DIR, f'{sha256}.docx')
+
+def _share_file(src, dst):
+    """Hard-link src as dst, or copy it where the filesystem can't link"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _cache_word_output(job_id, sha256):
+    try:
+        os.makedirs(WORD_CACHE_DIR, exist_ok=True)
+        tmp = f'{_word_cache_path(sha256)}.{job_id}.tmp'
+        _share_file(os.path.join(_word_job_dir(job_id), 'output.docx'), tmp)
+        os.replace(tmp, _word_cache_path(sha256))
+    except OSError:
+        import traceback
+        traceback.print_exc()
+
+def _run_word_job(job_id, sha256):
+    job_dir = _word_job_dir(job_id)
+    _write_word_job(job_id, status='running')
+    started = time.perf_counter()
+    try:
+        cv = Converter(os.path.join(job_dir, 'input.pdf'))
+        try:
+            processes = min(PDF2DOCX_PROCESSES, len(cv.fitz_doc))
+            if processes > 1:
+                with _word_pages_lock:
+                    cv.convert(os.path.join(job_dir, 'output.docx'), start=0, end=None,
+                               multi_processing=True, cpu_count=processes)
+            else:
+                cv.convert(os.path.join(job_dir, 'output.docx'), start=0, end=None)
+        finally:
+            cv.close()
+        remove_file(os.path.join(job_dir, 'input.pdf'))
+        _cache_word_output(job_id, sha256)
+        _write_word_job(job_id, status='done')
+        if JOB_SECONDS is not None:
+            JOB_SECONDS.labels('pdf_to_word').observe(time.perf_counter() - started)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        _write_word_job(job_id, status='failed', error=str(e))
+
+def cleanup_word_jobs():
+    """Remove job directories whose status has not changed within the TTL, and expired cached documents"""
+    try:
+        names = os.listdir(WORD_CACHE_DIR)
+    except OSError:
+        names = []
+    cutoff = time.time() - WORD_JOB_TTL
+    for name in names:
+        path = os.path.join(WORD_CACHE_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                remove_file(path)
+        except OSError:
+            pass
+    try:
+        names = os.listdir(WORD_JOBS_DIR)
+    except OSError:
+        return
+    cutoff = time.time() - max(WORD_JOB_TTL, WORD_JOB_TIMEOUT)
+    for name in names:
+        if name == 'cache':
+            continue
+        job_dir = os.path.join(WORD_JOBS_DIR, name)
+        try:
+            if os.path.getmtime(os.path.join(job_dir, 'status.json')) < cutoff:
+                shutil.rmtree(job_dir, ignore_errors=True)
+        except OSError:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+def submit_word_job(file):
+    """Queue a PDF upload for conversion and return its job status dict"""
+    cleanup_word_jobs()
+    # Random, so uploads of the same PDF never share a job's state or files
+    job_id = secrets.token_hex(32)
+    job_dir = _word_job_dir(job_id)
+    os.makedirs(job_dir)
+    digest = hashlib.sha256()
+    file.stream.seek(0)
+    with open(os.path.join(job_dir, 'input.pdf'), 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    sha256 = digest.hexdigest()
+    name = os.path.splitext(os.path.basename(file.filename or 'document.pdf'))[0] or 'document'
+    cached = _word_cache_path(sha256)
+    try:
+        if time.time() - os.path.getmtime(cached) < WORD_JOB_TTL:
+            _share_file(cached, os.path.join(job_dir, 'output.docx'))
+            remove_file(os.path.join(job_dir, 'input.pdf'))
+            return _write_word_job(job_id, status='done', filename=f'{name}.docx', error=None)
+    except OSError:
+        pass  # not cached, or expired and swept meanwhile
+    job = _write_word_job(job_id, status='queued', filename=f'{name}.docx', error=None)
+    _word_executor.submit(_run_word_job, job_id, sha256)
+    return job
+
+def append_image_page(writer, file, target_dpi=None, quality=85):
+    """Decode one uploaded image and append it to a StreamingPdfWriter.
+
+    Pages keep the physical size implied by the image DPI (72 when missing,
+    as PIL assumes). JPEGs that need no downsampling are embedded as-is;
+    everything else is decoded, optionally downsampled to target_dpi and
+    re-encoded as JPEG.
+    """
+    size = check_upload_size(file, 'img_to_pdf')
+    img = open_upload_image(file, 'img_to_pdf')
+    try:
+        orig_w, orig_h = img.info.get('original_size') or img.size
+        try:
+            src_dpi = float((img.info.get('dpi') or (72, 72))[0]) or 72.0
+        except (TypeError, ValueError):
+            src_dpi = 72.0
+        page_w = orig_w * 72.0 / src_dpi
+        page_h = orig_h * 72.0 / src_dpi
+        downsample = bool(target_dpi) and src_dpi > target_dpi
+        if (img.format == 'JPEG' and img.mode in ('RGB', 'L')
+                and not downsample and 'original_size' not in img.info):
+            file.stream.seek(0)
+            colorspace = 'DeviceGray' if img.mode == 'L' else 'DeviceRGB'
+            writer.add_image_page(file.stream, size, img.size[0], img.size[1], colorspace, page_w, page_h)
+            return
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('L' if img.mode in ('1', 'I', 'F', 'I;16') else 'RGB')
+        # draft() may already have shrunk a JPEG, so scale from the decoded size
+        current_dpi = src_dpi * img.size[0] / orig_w
+        if downsample and current_dpi > target_dpi:
+            scale = target_dpi / current_dpi
+            img = img.resize((max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale))), Image.LANCZOS)
+        encoded = io.BytesIO()
+        img.save(encoded, format='JPEG', quality=quality)
+        length = encoded.tell()
+        encoded.seek(0)
+        colorspace = 'DeviceGray' if img.mode == 'L' else 'DeviceRGB'
+        writer.add_image_page(encoded, length, img.size[0], img.size[1], colorspace, page_w, page_h)
+    finally:
+        img.close()
+
 @app.route('/pdf-tools', methods=['GET', 'POST'])
 def pdf_tools():
     if request.method == 'POST':
@@ -2802,28 +5439,32 @@ def pdf_tools():
                 if not files or files[0].filename == '':
                     return redirect(request.url)
                 
-                images = []
-                for file in files:
-                    img = Image.open(file)
-                    if img.mode == 'RGBA':
-                        img = img.convert('RGB')
-                    images.append(img)
+                try:
+                    target_dpi = int(request.form.get('dpi') or 0)
+                except ValueError:
+                    target_dpi = 0
+                try:
+                    quality = min(max(int(request.form.get('quality') or 85), 10), 95)
+                except ValueError:
+                    quality = 85
                 
-                if images:
-                    output_buffer = io.BytesIO()
-                    images[0].save(
-                        output_buffer, 
-                        format='PDF', 
-                        save_all=True, 
-                        append_images=images[1:]
-                    )
-                    output_buffer.seek(0)
-                    return send_file(
-                        output_buffer,
-                        as_attachment=True,
-                        download_name='converted_images.pdf',
-                        mimetype='application/pdf'
-                    )
+                # Pages are decoded and written one at a time straight to disk
+                out_path = scratch_path('.pdf')
+                try:
+                    with open(out_path, 'wb') as out:
+                        writer = StreamingPdfWriter(out)
+                        for file in files:
+                            append_image_page(writer, file, target_dpi, quality)
+                        writer.close()
+                except BaseException:
+                    remove_file(out_path)
+                    raise
+                return send_scratch_file(
+                    out_path,
+                    as_attachment=True,
+                    download_name='converted_images.pdf',
+                    mimetype='application/pdf'
+                )
 
             elif action == 'pdf_to_jpg':
                 if fitz is None:
@@ -2834,6 +5475,7 @@ def pdf_tools():
                     return redirect(request.url)
                 
                 # Read file content
+                check_upload_size(file, 'pdf_tools')
                 pdf_bytes = file.read()
                 doc = fitz.open(stream=pdf_bytes, filetype="pdf")
                 
@@ -2870,17 +5512,25 @@ def pdf_tools():
                 if not files or files[0].filename == '':
                     return redirect(request.url)
                 
+                # Uploads are already spooled to disk by LedgerRequest; pypdf
+                # reads them lazily and the result is written to a scratch file
                 merger = PdfWriter()
                 for file in files:
-                    merger.append(file)
+                    check_upload_size(file, 'pdf_tools')
+                    merger.append(file.stream)
+                dedupe_pdf_objects(merger)
                 
-                output_buffer = io.BytesIO()
-                merger.write(output_buffer)
-                merger.close()
-                output_buffer.seek(0)
+                out_path = scratch_path('.pdf')
+                try:
+                    with open(out_path, 'wb') as out:
+                        merger.write(out)
+                    merger.close()
+                except BaseException:
+                    remove_file(out_path)
+                    raise
                 
-                return send_file(
-                    output_buffer,
+                return send_scratch_file(
+                    out_path,
                     as_attachment=True,
                     download_name='merged_document.pdf',
                     mimetype='application/pdf'
@@ -2891,24 +5541,36 @@ def pdf_tools():
                 if not file or file.filename == '':
                     return redirect(request.url)
                 
-                reader = PdfReader(file)
-                writer = PdfWriter()
-                
-                for page in reader.pages:
-                    page.compress_content_streams()
-                    writer.add_page(page)
+                original_size = check_upload_size(file, 'pdf_tools')
                 
-                # Set compression level by just writing it out (pypdf compresses by default)
-                # We can also strip metadata
-                writer.add_metadata({})
+                if request.args.get('report') == '1':
+                    # Run every level and report size and time so a default can be chosen
+                    report = {'original_bytes': original_size, 'levels': {}}
+                    for name in PDF_COMPRESS_LEVELS:
+                        file.stream.seek(0)
+                        out = tempfile.TemporaryFile()
+                        started = time.perf_counter()
+                        stats = compress_pdf_file(file.stream, out, name)
+                        elapsed = time.perf_counter() - started
+                        size = out.tell()
+                        out.close()
+                        report['levels'][name] = dict(stats, bytes=size, seconds=round(elapsed, 3),
+                                                      ratio=round(size / float(original_size or 1), 3))
+                    return jsonify(report)
                 
-                output_buffer = io.BytesIO()
-                writer.write(output_buffer)
-                writer.close()
-                output_buffer.seek(0)
+                level = request.form.get('level') or PDF_COMPRESS_DEFAULT_LEVEL
+                if level not in PDF_COMPRESS_LEVELS:
+                    level = PDF_COMPRESS_DEFAULT_LEVEL
+                out_path = scratch_path('.pdf')
+                try:
+                    with open(out_path, 'wb') as out:
+                        compress_pdf_file(file.stream, out, level)
+                except BaseException:
+                    remove_file(out_path)
+                    raise
                 
-                return send_file(
-                    output_buffer,
+                return send_scratch_file(
+                    out_path,
                     as_attachment=True,
                     download_name=f'compressed_{file.filename}',
                     mimetype='application/pdf'
@@ -2922,32 +5584,12 @@ def pdf_tools():
                 if not file or file.filename == '':
                     return redirect(request.url)
                 
-                # pdf2docx requires a real file path, not a stream (usually)
-                # We need to save the uploaded file temporarily
-                temp_pdf = f"temp_{secrets.token_hex(8)}.pdf"
-                temp_docx = f"temp_{secrets.token_hex(8)}.docx"
-                
-                try:
-                    file.save(temp_pdf)
-                    
-                    cv = Converter(temp_pdf)
-                    cv.convert(temp_docx, start=0, end=None)
-                    cv.close()
-                    
-                    return send_file(
-                        temp_docx,
-                        as_attachment=True,
-                        download_name=f'{os.path.splitext(file.filename)[0]}.docx',
-                        mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-                    )
-                except Exception as e:
-                    raise e
-                finally:
-                    # Cleanup
-                    if os.path.exists(temp_pdf):
-                        os.remove(temp_pdf)
-                    if os.path.exists(temp_docx):
-                        os.remove(temp_docx)
+                # Conversion runs in the background; the page polls the job
+                check_upload_size(file, 'pdf_tools')
+                job = submit_word_job(file)
+                if request.args.get('async') == '1':
+                    return jsonify(job), 202
+                return redirect(url_for('pdf_tools', word_job=job['id']))
 
             elif action == 'unlock_pdf':
                 file = request.files.get('file')
@@ -2955,6 +5597,7 @@ def pdf_tools():
                 if not file or file.filename == '' or not password:
                     return redirect(request.url)
                 
+                check_upload_size(file, 'pdf_tools')
                 reader = PdfReader(file)
                 if reader.is_encrypted:
                     try:
@@ -2981,9 +5624,30 @@ def pdf_tools():
 
 
 
+        except RequestEntityTooLarge:
+            raise
         except Exception as e:
             import traceback
             traceback.print_exc()
             return f"Error processing PDF: {str(e)}"
 
-    return render_template('pdf_tools.html')
+    return render_template('pdf_tools.html', word_job=read_word_job(request.args.get('word_job')))
+
+@app.route('/pdf-tools/jobs/<job_id>')
+def word_job_status(job_id):
+    job = read_word_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job)
+
+@app.route('/pdf-tools/jobs/<job_id>/download')
+def word_job_download(job_id):
+    job = read_word_job(job_id)
+    if not job or job['status'] != 'done':
+        return redirect(url_for('pdf_tools', word_job=job_id))
+    return send_file(
+        os.path.join(_word_job_dir(job_id), 'output.docx'),
+        as_attachment=True,
+        download_name=job.get('filename') or 'document.docx',
+        mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+    )
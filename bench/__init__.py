@@ -0,0 +1,6 @@
+"""Benchmark harness for the ledger app.
+
+    python -m bench.seed --db bench.db --transactions 20000
+    python -m bench.run --db bench.db --output baseline.json
+    python -m bench.run --db bench.db --compare baseline.json
+"""
@@ -0,0 +1,165 @@
+"""Drive the main routes through Flask's test client and report latencies."""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+
+SCENARIOS = ['index', 'transactions', 'add_transaction', 'pay_transaction', 'export_transactions', 'image_processing']
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not samples:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(samples)))
+    return samples[min(rank, len(samples)) - 1]
+
+
+def make_image():
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (1600, 1200), (120, 160, 200)).save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+
+class Bench:
+    def __init__(self, ledger, model_name):
+        self.ledger = ledger
+        self.client = ledger.app.test_client()
+        conn = ledger.sqlite3.connect(ledger.DATABASE)
+        conn.row_factory = ledger.sqlite3.Row
+        model = conn.execute('SELECT id, name FROM models WHERE name = ?', (model_name,)).fetchone()
+        if not model:
+            raise SystemExit(f'Model {model_name!r} not found; run python -m bench.seed first')
+        self.model_id = model['id']
+        self.client_name = conn.execute('SELECT client_name FROM clients WHERE model_id = ? LIMIT 1', (self.model_id,)).fetchone()['client_name']
+        self.country = conn.execute('SELECT name FROM countries ORDER BY name LIMIT 1').fetchone()['name']
+        self.unpaid = [r['id'] for r in conn.execute(
+            'SELECT id FROM transactions WHERE model_id = ? AND is_paid = 0 ORDER BY id DESC', (self.model_id,))]
+        self.next_app_id = (conn.execute('SELECT MAX(app_id) FROM transactions').fetchone()[0] or 0) + 1
+        conn.close()
+        self.image = make_image()
+        with self.client.session_transaction() as s:
+            s['user_id'] = 1
+            s['username'] = 'bench'
+            s['permissions'] = {'is_admin': True, 'can_view_clients': True}
+            s['model_id'] = self.model_id
+            s['model_name'] = model_name
+
+    def index(self):
+        return self.client.get('/')
+
+    def transactions(self):
+        return self.client.get('/transactions')
+
+    def add_transaction(self):
+        self.next_app_id += 1
+        return self.client.post('/transactions/add', data={
+            'client_name': self.client_name, 'applicant_name': 'Bench Applicant', 'email': 'bench@example.com',
+            'service_type': 'eVisa', 'app_id': str(self.next_app_id), 'country_name': self.country,
+            'rate': '1500', 'add': '0', 'transaction_date': datetime.now().strftime('%Y-%m-%d'),
+        })
+
+    def pay_transaction(self):
+        if not self.unpaid:
+            raise SystemExit('Ran out of unpaid transactions; seed more data')
+        return self.client.post(f'/transactions/{self.unpaid.pop()}/pay')
+
+    def export_transactions(self):
+        date_from = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+        return self.client.get(f'/transactions/export?format=pdf&date_from={date_from}')
+
+    def image_processing(self):
+        return self.client.post('/image-processing', data={
+            'image': (io.BytesIO(self.image), 'bench.jpg'), 'action': 'convert_gray',
+        }, content_type='multipart/form-data')
+
+    def measure(self, name, iterations, warmup):
+        call = getattr(self, name)
+        timings = []
+        for i in range(warmup + iterations):
+            start = time.perf_counter()
+            response = call()
+            elapsed = (time.perf_counter() - start) * 1000
+            response.close()
+            if response.status_code >= 400:
+                raise SystemExit(f'{name}: HTTP {response.status_code}')
+            if i >= warmup:
+                timings.append(elapsed)
+        timings.sort()
+        result = {f'p{p}': round(percentile(timings, p), 3) for p in PERCENTILES}
+        result['mean'] = round(sum(timings) / len(timings), 3)
+        result['n'] = len(timings)
+        return result
+
+
+def compare(results, baseline, threshold):
+    """Print deltas against a baseline; return True if any p95 regressed past threshold"""
+    regressed = False
+    print(f"\n{'scenario':<22}" + ''.join(f'{f"p{p} delta":>14}' for p in PERCENTILES))
+    for name, res in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print(f'{name:<22}  (not in baseline)')
+            continue
+        cells = []
+        for p in PERCENTILES:
+            key = f'p{p}'
+            delta = (res[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+            cells.append(f'{delta:>+13.1f}%')
+            if key == 'p95' and delta > threshold:
+                regressed = True
+        print(f'{name:<22}' + ''.join(cells))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default='bench.db', help='SQLite file created by bench.seed')
+    parser.add_argument('--model', default='Bench')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--output', help='Write results as a JSON baseline')
+    parser.add_argument('--compare', help='Baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed p95 regression in percent')
+    args = parser.parse_args(argv)
+
+    os.environ['DATABASE'] = args.db
+    os.environ.setdefault('SLOW_REQUEST_MS', '1e9')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as ledger
+    ledger.DATABASE = args.db
+    ledger.init_db()
+    bench = Bench(ledger, args.model)
+
+    results = {}
+    print(f"{'scenario':<22}" + ''.join(f'{f"p{p} ms":>10}' for p in PERCENTILES) + f"{'mean ms':>10}")
+    for name in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+        if name not in SCENARIOS:
+            raise SystemExit(f'Unknown scenario {name!r}')
+        res = results[name] = bench.measure(name, args.iterations, args.warmup)
+        print(f'{name:<22}' + ''.join(f"{res[f'p{p}']:>10.2f}" for p in PERCENTILES) + f"{res['mean']:>10.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({
+                'meta': {'created': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                         'iterations': args.iterations, 'db': os.path.basename(args.db)},
+                'results': results,
+            }, fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Generate a synthetic ledger database for benchmarking."""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+SERVICE_TYPES = ['eVisa', 'Visa', 'Passport', 'Permit']
+FIRST_NAMES = ['Ada', 'Bola', 'Chidi', 'Dayo', 'Emeka', 'Funmi', 'Gbenga', 'Halima', 'Ife', 'Jide', 'Kemi', 'Lola']
+LAST_NAMES = ['Okafor', 'Adeyemi', 'Bello', 'Eze', 'Ibrahim', 'Nwosu', 'Ogunleye', 'Suleiman', 'Uche', 'Yusuf']
+OPENING_BALANCE = 1e9
+
+
+def model_names(model_name, models):
+    """`model_name`, then `model_name 2`, `model_name 3`, ... for extra models"""
+    return [model_name] + [f'{model_name} {k}' for k in range(2, models + 1)]
+
+
+def seed(db_path, clients=50, transactions=20000, days=365, model_name='Bench', rng_seed=42,
+         models=1, countries=0, country_skew=0.0):
+    """Create (or top up) `models` models named after `model_name` with synthetic data.
+
+    Each model gets `clients` clients and `transactions` transactions spread
+    over the last `days` days, plus the balance history of its paid ones.
+    `countries` limits how many countries are used (0 for all) and
+    `country_skew` weights the n-th most used one by 1 / n ** skew, so a few
+    countries carry most of the volume.
+
+    Returns the id of the first model.
+    """
+    os.environ['DATABASE'] = db_path
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as ledger
+    ledger.DATABASE = db_path
+    ledger.init_db()
+
+    rng = random.Random(rng_seed)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+
+    catalog = [r['name'] for r in conn.execute('SELECT name FROM countries ORDER BY name')]
+    prices = {name: round(rng.uniform(50, 400), 2) for name in catalog}
+    conn.executemany('UPDATE countries SET price = ? WHERE name = ?', [(p, n) for n, p in prices.items()])
+    conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'countries'")
+    used = rng.sample(catalog, countries) if 0 < countries < len(catalog) else list(catalog)
+    weights = [1.0 / (rank + 1) ** country_skew for rank in range(len(used))]
+
+    ids = []
+    for name in model_names(model_name, models):
+        ids.append(seed_model(conn, rng, name, clients, transactions, days, used, weights, prices))
+        ledger.rebuild_rollups(conn, ids[-1])
+    conn.close()
+    return ids[0]
+
+
+def seed_model(conn, rng, model_name, clients, transactions, days, countries, weights, prices):
+    conn.execute('INSERT OR IGNORE INTO models (name) VALUES (?)', (model_name,))
+    model_id = conn.execute('SELECT id FROM models WHERE name = ?', (model_name,)).fetchone()['id']
+
+    # Clients, each opened with a credit in balance_history
+    last_client = conn.execute('SELECT COALESCE(MAX(id), 0) FROM clients').fetchone()[0]
+    client_names = [f'Bench Client {i:04d}' for i in range(clients)]
+    conn.executemany(
+        'INSERT OR IGNORE INTO clients (client_name, phone_number, balance, model_id) VALUES (?, ?, ?, ?)',
+        [(name, f'080{rng.randrange(10**8):08d}', OPENING_BALANCE, model_id) for name in client_names])
+    now = datetime.now()
+    opened = (now - timedelta(days=days + 1)).strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute('''
+        INSERT INTO balance_history (client_id, amount, type, balance_before, balance_after, description, timestamp, model_id)
+        SELECT id, balance, 'credit', 0, balance, 'Opening balance', ?, model_id FROM clients WHERE id > ? AND model_id = ?
+    ''', (opened, last_client, model_id))
+
+    last_transaction = conn.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+    start_app_id = (conn.execute('SELECT MAX(app_id) FROM transactions').fetchone()[0] or 10**9) + 1
+    rows = []
+    for i in range(transactions):
+        country = rng.choices(countries, weights)[0]
+        rate = rng.choice([1.0, 1500.0, 1550.0, 1600.0])
+        addition = rng.choice([0.0, 0.0, 10.0, 25.0])
+        amount = prices[country] + addition
+        applicant = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        when = now - timedelta(days=rng.uniform(0, days))
+        rows.append((
+            rng.choice(client_names), f'{applicant.lower().replace(" ", ".")}@example.com',
+            rng.choice(SERVICE_TYPES), applicant, start_app_id + i, country, prices[country],
+            rate, addition, amount, amount * rate, when.strftime('%Y-%m-%d %H:%M:%S'),
+            1 if rng.random() < 0.6 else 0, model_id))
+    conn.executemany('''
+        INSERT INTO transactions
+        (client_name, email, service_type, applicant_name, app_id, country_name, country_price,
+         rate, addition, amount, amount_n, transaction_date, is_paid, model_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+    # Debit each new paid transaction in date order, as pay_transaction would
+    balances = {r['client_name']: (r['id'], r['balance'])
+                for r in conn.execute('SELECT id, client_name, balance FROM clients WHERE model_id = ?', (model_id,))}
+    history = []
+    for t in conn.execute('SELECT id, client_name, amount_n, transaction_date FROM transactions WHERE id > ? AND model_id = ? AND is_paid = 1 ORDER BY transaction_date, id',
+                          (last_transaction, model_id)).fetchall():
+        client_id, before = balances[t['client_name']]
+        after = before - t['amount_n']
+        balances[t['client_name']] = (client_id, after)
+        history.append((client_id, t['id'], t['amount_n'], 'debit', before, after,
+                        f"Payment for transaction #{t['id']}", t['transaction_date'], model_id))
+    conn.executemany('''
+        INSERT INTO balance_history (client_id, transaction_id, amount, type, balance_before, balance_after, description, timestamp, model_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', history)
+    conn.executemany('UPDATE clients SET balance = ? WHERE id = ?', [(b, cid) for cid, b in balances.values()])
+    conn.commit()
+    return model_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default='bench.db', help='SQLite file to create or extend')
+    parser.add_argument('--clients', type=int, default=50, help='Clients per model')
+    parser.add_argument('--transactions', type=int, default=20000, help='Transactions per model')
+    parser.add_argument('--days', type=int, default=365, help='Spread transactions over this many past days')
+    parser.add_argument('--model', default='Bench', help='Model name to seed into')
+    parser.add_argument('--models', type=int, default=1, help='Number of models (extra ones are named "<model> 2", ...)')
+    parser.add_argument('--countries', type=int, default=0, help='Number of countries to use (0 for all)')
+    parser.add_argument('--country-skew', type=float, default=0.0,
+                        help='Zipf exponent for country volumes (0 spreads them evenly)')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    args = parser.parse_args(argv)
+    model_id = seed(args.db, args.clients, args.transactions, args.days, args.model, args.seed,
+                    args.models, args.countries, args.country_skew)
+    print(f'Seeded {args.transactions} transactions for {args.clients} clients into {args.models} model(s), '
+          f'starting at model #{model_id} ({args.db})')
+
+
+if __name__ == '__main__':
+    main()
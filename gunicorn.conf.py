@@ -0,0 +1,22 @@
+# Gunicorn settings picked up automatically from the working directory.
+# With PROMETHEUS_MULTIPROC_DIR set, each worker writes its metric samples
+# there and /metrics aggregates them; dead workers must be marked so their
+# live gauges drop out.
+import os
+import shutil
+
+
+def on_starting(server):
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        try:
+            from prometheus_client import multiprocess
+        except ImportError:
+            return
+        multiprocess.mark_process_dead(worker.pid)
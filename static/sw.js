@@ -1,4 +1,5 @@
-const CACHE_NAME = 'bdj-ledger-v2';
+const CACHE_NAME = 'bdj-ledger-v3';
+const CATALOG_URLS = ['/api/countries'];
 const STATIC_ASSETS = [
   '/static/style.css',
   '/static/main.js',
@@ -42,6 +43,23 @@ self.addEventListener('fetch', event => {
     return;
   }
 
+  // Catalog APIs: Network First (revalidated via ETag), cached copy when offline
+  const url = new URL(event.request.url);
+  if (url.origin === self.location.origin && CATALOG_URLS.includes(url.pathname)) {
+    event.respondWith(
+      fetch(event.request)
+        .then(response => {
+          if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE_NAME).then(cache => cache.put(event.request, copy));
+          }
+          return response;
+        })
+        .catch(() => caches.match(event.request))
+    );
+    return;
+  }
+
   // Static assets: Cache First, then Network
   event.respondWith(
     caches.match(event.request)